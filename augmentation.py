@@ -1,17 +1,14 @@
 # -*- coding=utf-8 -*-
 
-import time
 import random
-import copy
-import cv2
 import os
 import math
 import numpy as np
-from skimage.util import random_noise
-from lxml import etree, objectify
 import xml.etree.ElementTree as ET
 import argparse
 
+# OpenCV、skimage与lxml导入较慢，只在用到的增强操作或输出函数内导入
+
 
 # 显示图片
 def show_pic(img, bboxes=None):
@@ -20,6 +17,8 @@ def show_pic(img, bboxes=None):
         :param bboxes:图像的所有boudning box list, 格式为[[x_min, y_min, x_max, y_max]....]
         :param names:每个box对应的名称
     """
+    import cv2
+
     for i in range(len(bboxes)):
         bbox = bboxes[i]
         x_min = bbox[0]
@@ -42,7 +41,7 @@ class DataAugmentForObjectDetection():
                  add_noise_rate=0.5, flip_rate=0.5,
                  cutout_rate=0.5, cut_out_length=50, cut_out_holes=1, cut_out_threshold=0.5,
                  is_addNoise=True, is_changeLight=True, is_cutout=True, is_rotate_img_bbox=True,
-                 is_crop_img_bboxes=True, is_shift_pic_bboxes=True, is_filp_pic_bboxes=True):
+                 is_crop_img_bboxes=True, is_shift_pic_bboxes=True, is_filp_pic_bboxes=True, keep_quad=False):
 
         # 配置各个操作的属性
         self.rotation_rate = rotation_rate
@@ -67,70 +66,85 @@ class DataAugmentForObjectDetection():
         self.is_shift_pic_bboxes = is_shift_pic_bboxes
         self.is_filp_pic_bboxes = is_filp_pic_bboxes
 
+        # 框的格式：输入可以是(N, 4)的[x_min, y_min, x_max, y_max]或(N, 8)的四边形[x1, y1, ..., x4, y4]；
+        # keep_quad为True时输出(N, 8)的四边形（DOTA格式，旋转后不再外接为水平框），否则输出(N, 4)的水平框
+        self.keep_quad = keep_quad
+
     # ----1.加噪声---- #
-    def _addNoise(self, img):
+    # 每次处理的噪声元素个数上限，噪声暂存区只有这么大，与图像尺寸无关
+    NOISE_BLOCK_SIZE = 1 << 18
+
+    def _addNoise(self, img, rng=random, sigma=25.5):
         '''
+        加高斯噪声,与skimage.util.random_noise(mode='gaussian')默认的方差0.01相同(0-255下标准差为25.5)。
+        按行分块生成float32噪声,暂存区在多次调用间复用,不会分配与整幅图同样大小的float64数组
         输入:
-            img:图像array
+            img:uint8图像array,原地修改
+            rng:随机数生成器(random.Random),噪声种子从中抽取,固定rng时结果可复现
+            sigma:噪声标准差
         输出:
-            加噪声后的图像array,由于输出的像素是在[0,1]之间,所以得乘以255
+            加噪声后的图像array(即img),仍为uint8
         '''
-        # return cv2.GaussianBlur(img, (11, 11), 0)
-        return random_noise(img, mode='gaussian', seed=int(time.time()), clip=True) * 255
+        noise_rng = np.random.Generator(np.random.PCG64(rng.getrandbits(64)))
+        # 直接按img的行切片写回,img不连续(如切片视图)时也是原地修改;reshape在不连续时会悄悄复制,噪声就丢了
+        row_size = img[0].size
+        block_rows = max(1, self.NOISE_BLOCK_SIZE // row_size)
+        scratch = getattr(self, '_noise_scratch', None)
+        if scratch is None or scratch.size < block_rows * row_size:
+            scratch = self._noise_scratch = np.empty(block_rows * row_size, dtype=np.float32)
+        for start in range(0, img.shape[0], block_rows):
+            block = img[start:start + block_rows]
+            noise = scratch[:block.size].reshape(block.shape)
+            noise_rng.standard_normal(dtype=np.float32, out=noise)
+            noise *= sigma
+            noise += block
+            np.clip(noise, 0, 255, out=noise)
+            np.rint(noise, out=noise)
+            block[...] = noise
+        return img
 
     # ---2.调整亮度--- #
-    def _changeLight(self, img):
-        alpha = random.uniform(0.35, 1)
-        blank = np.zeros(img.shape, img.dtype)
-        return cv2.addWeighted(img, alpha, blank, 1 - alpha, 0)
+    def _changeLight(self, img, rng=random):
+        '''
+        按随机系数整体调暗,通过查找表原地完成,取整方式与cv2.addWeighted一致
+        输入:
+            img:uint8图像array,原地修改
+        输出:
+            调整亮度后的图像array(即img)
+        '''
+        import cv2
+
+        alpha = rng.uniform(0.35, 1)
+        lut = np.clip(np.rint(np.arange(256) * alpha), 0, 255).astype(np.uint8)
+        return cv2.LUT(img, lut, dst=img)
 
     # ---3.cutout--- #
-    def _cutout(self, img, bboxes, length=100, n_holes=1, threshold=0.5):
+    def _cutout(self, img, bboxes, length=100, n_holes=1, threshold=0.5, rng=random):
         '''
         原版本：https://github.com/uoguelph-mlrg/Cutout/blob/master/util/cutout.py
         Randomly mask out one or more patches from an image.
         Args:
             img : a 3D numpy array,(h,w,c)
-            bboxes : 框的坐标
+            bboxes : 框的坐标,(N, 4)或(N, 8)
             n_holes (int): Number of patches to cut out of each image.
             length (int): The length (in pixels) of each square patch.
+            rng : 随机数生成器(random.Random)
+        img原地修改,挖去的区域直接置0,返回img(仍为uint8)
         '''
 
-        def cal_iou(boxA, boxB):
-            '''
-            boxA, boxB为两个框，返回iou
-            boxB为bouding box
-            '''
-            # determine the (x, y)-coordinates of the intersection rectangle
-            xA = max(boxA[0], boxB[0])
-            yA = max(boxA[1], boxB[1])
-            xB = min(boxA[2], boxB[2])
-            yB = min(boxA[3], boxB[3])
-
-            if xB <= xA or yB <= yA:
-                return 0.0
-
-            # compute the area of intersection rectangle
-            interArea = (xB - xA + 1) * (yB - yA + 1)
-
-            # compute the area of both the prediction and ground-truth
-            # rectangles
-            boxAArea = (boxA[2] - boxA[0] + 1) * (boxA[3] - boxA[1] + 1)
-            boxBArea = (boxB[2] - boxB[0] + 1) * (boxB[3] - boxB[1] + 1)
-            iou = interArea / float(boxBArea)
-            return iou
-
         # 得到h和w
         if img.ndim == 3:
             h, w, c = img.shape
         else:
             _, h, w, c = img.shape
-        mask = np.ones((h, w, c), np.float32)
+        extents = self._get_extents(bboxes)
+        # 与原做法一致，按像素个数(+1)计算各框的面积，重叠程度为交集占框面积的比例
+        box_areas = (extents[:, 2] - extents[:, 0] + 1) * (extents[:, 3] - extents[:, 1] + 1)
         for n in range(n_holes):
             chongdie = True  # 看切割的区域是否与box重叠太多
             while chongdie:
-                y = np.random.randint(h)
-                x = np.random.randint(w)
+                y = rng.randrange(h)
+                x = rng.randrange(w)
 
                 y1 = np.clip(y - length // 2, 0,
                              h)  # numpy.clip(a, a_min, a_max, out=None), clip这个函数将将数组中的元素限制在a_min, a_max之间，大于a_max的就使得它等于 a_max，小于a_min,的就使得它等于a_min
@@ -138,98 +152,72 @@ class DataAugmentForObjectDetection():
                 x1 = np.clip(x - length // 2, 0, w)
                 x2 = np.clip(x + length // 2, 0, w)
 
-                chongdie = False
-                for box in bboxes:
-                    if cal_iou([x1, y1, x2, y2], box) > threshold:
-                        chongdie = True
-                        break
-            mask[y1: y2, x1: x2, :] = 0.
-        img = img * mask
+                # 一次性计算与全部框的重叠
+                x_a = np.maximum(x1, extents[:, 0])
+                y_a = np.maximum(y1, extents[:, 1])
+                x_b = np.minimum(x2, extents[:, 2])
+                y_b = np.minimum(y2, extents[:, 3])
+                inter_areas = np.where((x_b > x_a) & (y_b > y_a), (x_b - x_a + 1) * (y_b - y_a + 1), 0)
+                chongdie = bool((inter_areas / box_areas > threshold).any())
+            img[..., y1: y2, x1: x2, :] = 0
         return img
 
     # ---4.旋转--- #
-    def _rotate_img_bbox(self, img, bboxes, angle=5, scale=1.):
+    def _get_rotate_matrix(self, size, angle, scale=1.):
         '''
-        参考:https://blog.csdn.net/u014540717/article/details/53301195crop_rate
+        旋转并缩放,画布扩大到能容纳旋转后的整张图
         输入:
-            img:图像array,(h,w,c)
-            bboxes:该图像包含的所有boundingboxs,一个list,每个元素为[x_min, y_min, x_max, y_max],要确保是数值
+            size:当前画布(w,h)
             angle:旋转角度
-            scale:默认1
+            scale:缩放比例
         输出:
-            rot_img:旋转后的图像array
-            rot_bboxes:旋转后的boundingbox坐标list
+            matrix:3x3仿射矩阵(连续坐标,像素i覆盖[i,i+1))
+            new_size:旋转后的画布(w,h)
         '''
-        # 旋转图像
-        w = img.shape[1]
-        h = img.shape[0]
+        import cv2
+
+        w, h = size
         # 角度变弧度
         rangle = np.deg2rad(angle)  # angle in radians
         # now calculate new image width and height
         nw = (abs(np.sin(rangle) * h) + abs(np.cos(rangle) * w)) * scale
         nh = (abs(np.cos(rangle) * h) + abs(np.sin(rangle) * w)) * scale
-        # ask OpenCV for the rotation matrix
-        rot_mat = cv2.getRotationMatrix2D((nw * 0.5, nh * 0.5), angle, scale)
-        # calculate the move from the old center to the new center combined
-        # with the rotation
-        rot_move = np.dot(rot_mat, np.array([(nw - w) * 0.5, (nh - h) * 0.5, 0]))
-        # the move only affects the translation, so update the translation
-        rot_mat[0, 2] += rot_move[0]
-        rot_mat[1, 2] += rot_move[1]
-        # 仿射变换
-        rot_img = cv2.warpAffine(img, rot_mat, (int(math.ceil(nw)), int(math.ceil(nh))), flags=cv2.INTER_LANCZOS4)
-
-        # 矫正bbox坐标
-        # rot_mat是最终的旋转矩阵
-        # 获取原始bbox的四个中点，然后将这四个点转换到旋转后的坐标系下
-        rot_bboxes = list()
-        for bbox in bboxes:
-            xmin = bbox[0]
-            ymin = bbox[1]
-            xmax = bbox[2]
-            ymax = bbox[3]
-            point1 = np.dot(rot_mat, np.array([(xmin + xmax) / 2, ymin, 1]))
-            point2 = np.dot(rot_mat, np.array([xmax, (ymin + ymax) / 2, 1]))
-            point3 = np.dot(rot_mat, np.array([(xmin + xmax) / 2, ymax, 1]))
-            point4 = np.dot(rot_mat, np.array([xmin, (ymin + ymax) / 2, 1]))
-            # 合并np.array
-            concat = np.vstack((point1, point2, point3, point4))
-            # 改变array类型
-            concat = concat.astype(np.int32)
-            # 得到旋转后的坐标
-            rx, ry, rw, rh = cv2.boundingRect(concat)
-            rx_min = rx
-            ry_min = ry
-            rx_max = rx + rw
-            ry_max = ry + rh
-            # 加入list中
-            rot_bboxes.append([rx_min, ry_min, rx_max, ry_max])
-
-        return rot_img, rot_bboxes
+        # 先把原图平移到新画布中央，再绕新画布中心旋转缩放
+        matrix = np.eye(3)
+        matrix[:2] = cv2.getRotationMatrix2D((nw * 0.5, nh * 0.5), angle, scale)
+        return matrix @ self._get_translate_matrix((nw - w) * 0.5, (nh - h) * 0.5), (int(math.ceil(nw)),
+                                                                                      int(math.ceil(nh)))
+
+    def _rotate_img_bbox(self, img, bboxes, angle=5, scale=1.):
+        '''
+        参考:https://blog.csdn.net/u014540717/article/details/53301195crop_rate
+        输入:
+            img:图像array,(h,w,c)
+            bboxes:该图像包含的所有boundingboxs,(N, 4)或(N, 8)
+            angle:旋转角度
+            scale:默认1
+        输出:
+            rot_img:旋转后的图像array
+            rot_bboxes:旋转后的boundingbox坐标array
+        '''
+        matrix, size = self._get_rotate_matrix((img.shape[1], img.shape[0]), angle, scale)
+        return self._warp_img_bboxes(img, bboxes, matrix, size)
 
     # ---5.裁剪--- #
-    def _crop_img_bboxes(self, img, bboxes):
+    def _crop_img_bboxes(self, img, bboxes, rng=random):
         '''
         裁剪后的图片要包含所有的框
         输入:
             img:图像array
-            bboxes:该图像包含的所有boundingboxs,一个list,每个元素为[x_min, y_min, x_max, y_max],要确保是数值
+            bboxes:该图像包含的所有boundingboxs,(N, 4)或(N, 8)
         输出:
             crop_img:裁剪后的图像array
-            crop_bboxes:裁剪后的bounding box的坐标list
+            crop_bboxes:裁剪后的bounding box的坐标array
         '''
         # 裁剪图像
         w = img.shape[1]
         h = img.shape[0]
-        x_min = w  # 裁剪后的包含所有目标框的最小的框
-        x_max = 0
-        y_min = h
-        y_max = 0
-        for bbox in bboxes:
-            x_min = min(x_min, bbox[0])
-            y_min = min(y_min, bbox[1])
-            x_max = max(x_max, bbox[2])
-            y_max = max(y_max, bbox[3])
+        x_min, y_min, x_max, y_max = self._get_union_extent(bboxes, (w, h))  # 裁剪后的包含所有目标框的最小的框
 
         d_to_left = x_min  # 包含所有目标框的最小框到左边的距离
         d_to_right = w - x_max  # 包含所有目标框的最小框到右边的距离
@@ -237,10 +225,10 @@ class DataAugmentForObjectDetection():
         d_to_bottom = h - y_max  # 包含所有目标框的最小框到底部的距离
 
         # 随机扩展这个最小框
-        crop_x_min = int(x_min - random.uniform(0, d_to_left))
-        crop_y_min = int(y_min - random.uniform(0, d_to_top))
-        crop_x_max = int(x_max + random.uniform(0, d_to_right))
-        crop_y_max = int(y_max + random.uniform(0, d_to_bottom))
+        crop_x_min = int(x_min - rng.uniform(0, d_to_left))
+        crop_y_min = int(y_min - rng.uniform(0, d_to_top))
+        crop_x_max = int(x_max + rng.uniform(0, d_to_right))
+        crop_y_max = int(y_max + rng.uniform(0, d_to_bottom))
 
         # 随机扩展这个最小框 , 防止别裁的太小
         # crop_x_min = int(x_min - random.uniform(d_to_left//2, d_to_left))
@@ -256,150 +244,256 @@ class DataAugmentForObjectDetection():
 
         crop_img = img[crop_y_min:crop_y_max, crop_x_min:crop_x_max]
 
-        # 裁剪boundingbox
-        # 裁剪后的boundingbox坐标计算
-        crop_bboxes = list()
-        for bbox in bboxes:
-            crop_bboxes.append([bbox[0] - crop_x_min, bbox[1] - crop_y_min, bbox[2] - crop_x_min, bbox[3] - crop_y_min])
-
-        return crop_img, crop_bboxes
+        # 裁剪boundingbox，即整体平移
+        return crop_img, self._transform_bboxes(bboxes, self._get_translate_matrix(-crop_x_min, -crop_y_min))
 
     # ---6.平移--- #
-    def _shift_pic_bboxes(self, img, bboxes):
+    def _get_shift_matrix(self, size, bboxes, rng=random):
         '''
-        平移后的图片要包含所有的框
+        随机平移,平移后的图片要包含所有的框
         输入:
-            img:图像array
-            bboxes:该图像包含的所有boundingboxs,一个list,每个元素为[x_min, y_min, x_max, y_max],要确保是数值
+            size:当前画布(w,h)
+            bboxes:当前画布上的所有框,(N, 4)或(N, 8)
         输出:
-            shift_img:平移后的图像array
-            shift_bboxes:平移后的bounding box的坐标list
+            3x3仿射矩阵
         '''
-        # 平移图像
-        w = img.shape[1]
-        h = img.shape[0]
-        x_min = w  # 裁剪后的包含所有目标框的最小的框
-        x_max = 0
-        y_min = h
-        y_max = 0
-        for bbox in bboxes:
-            x_min = min(x_min, bbox[0])
-            y_min = min(y_min, bbox[1])
-            x_max = max(x_max, bbox[2])
-            y_max = max(y_max, bbox[3])
+        w, h = size
+        x_min, y_min, x_max, y_max = self._get_union_extent(bboxes, size)  # 包含所有目标框的最小的框
 
         d_to_left = x_min  # 包含所有目标框的最大左移动距离
         d_to_right = w - x_max  # 包含所有目标框的最大右移动距离
         d_to_top = y_min  # 包含所有目标框的最大上移动距离
         d_to_bottom = h - y_max  # 包含所有目标框的最大下移动距离
 
-        x = random.uniform(-(d_to_left - 1) / 3, (d_to_right - 1) / 3)
-        y = random.uniform(-(d_to_top - 1) / 3, (d_to_bottom - 1) / 3)
-
-        M = np.float32([[1, 0, x], [0, 1, y]])  # x为向左或右移动的像素值,正为向右负为向左; y为向上或者向下移动的像素值,正为向下负为向上
-        shift_img = cv2.warpAffine(img, M, (img.shape[1], img.shape[0]))
-
-        #  平移boundingbox
-        shift_bboxes = list()
-        for bbox in bboxes:
-            shift_bboxes.append([bbox[0] + x, bbox[1] + y, bbox[2] + x, bbox[3] + y])
+        # x为向左或右移动的像素值,正为向右负为向左; y为向上或者向下移动的像素值,正为向下负为向上
+        x = rng.uniform(-(d_to_left - 1) / 3, (d_to_right - 1) / 3)
+        y = rng.uniform(-(d_to_top - 1) / 3, (d_to_bottom - 1) / 3)
+        return self._get_translate_matrix(x, y)
 
-        return shift_img, shift_bboxes
+    def _shift_pic_bboxes(self, img, bboxes, rng=random):
+        '''
+        平移后的图片要包含所有的框
+        输入:
+            img:图像array
+            bboxes:该图像包含的所有boundingboxs,(N, 4)或(N, 8)
+        输出:
+            shift_img:平移后的图像array
+            shift_bboxes:平移后的bounding box的坐标array
+        '''
+        size = (img.shape[1], img.shape[0])
+        return self._warp_img_bboxes(img, bboxes, self._get_shift_matrix(size, bboxes, rng), size)
 
     # ---7.镜像--- #
-    def _filp_pic_bboxes(self, img, bboxes):
+    def _get_flip_matrix(self, size, rng=random):
         '''
-            平移后的图片要包含所有的框
+        0.33的概率垂直翻转，0.33的概率水平翻转,0.33是水平垂直翻转
+        输入:
+            size:当前画布(w,h)
+        输出:
+            3x3仿射矩阵
+        '''
+        w, h = size
+        sed = rng.random()
+        if 0 < sed < 0.33:
+            return np.array([[1., 0, 0], [0, -1, h], [0, 0, 1]])  # 垂直翻转
+        elif 0.33 < sed < 0.66:
+            return np.array([[-1., 0, w], [0, 1, 0], [0, 0, 1]])  # 水平翻转
+        return np.array([[-1., 0, w], [0, -1, h], [0, 0, 1]])  # 水平垂直翻转
+
+    def _filp_pic_bboxes(self, img, bboxes, rng=random):
+        '''
+            翻转后的图片要包含所有的框
             输入:
                 img:图像array
-                bboxes:该图像包含的所有boundingboxs,一个list,每个元素为[x_min, y_min, x_max, y_max],要确保是数值
+                bboxes:该图像包含的所有boundingboxs,(N, 4)或(N, 8)
             输出:
-                flip_img:平移后的图像array
-                flip_bboxes:平移后的bounding box的坐标list
+                flip_img:翻转后的图像array
+                flip_bboxes:翻转后的bounding box的坐标array
         '''
-        # 翻转图像
+        size = (img.shape[1], img.shape[0])
+        return self._warp_img_bboxes(img, bboxes, self._get_flip_matrix(size, rng), size)
+
+    # ---几何变换的合并执行--- #
+    @staticmethod
+    def _get_translate_matrix(x, y):
+        return np.array([[1., 0, x], [0, 1, y], [0, 0, 1]])
 
-        flip_img = copy.deepcopy(img)
-        h, w, _ = img.shape
+    @staticmethod
+    def _as_boxes(bboxes):
+        '''
+        :param bboxes: 框的list或array，每个框为[x_min, y_min, x_max, y_max]或[x1, y1, ..., x4, y4]
+        :return: (N, 4)或(N, 8)的float64数组
+        '''
+        boxes = np.asarray(bboxes, dtype=np.float64)
+        return boxes.reshape(0, 4) if not boxes.size else boxes
 
-        sed = random.random()
+    @classmethod
+    def _get_extents(cls, bboxes):
+        '''
+        :return: (N, 4)数组，每行为框的外接水平框[x_min, y_min, x_max, y_max]
+        '''
+        boxes = cls._as_boxes(bboxes)
+        if boxes.shape[1] == 4:
+            return boxes
+        return np.concatenate([boxes[:, 0::2].min(axis=1, keepdims=True), boxes[:, 1::2].min(axis=1, keepdims=True),
+                               boxes[:, 0::2].max(axis=1, keepdims=True), boxes[:, 1::2].max(axis=1, keepdims=True)],
+                              axis=1)
+
+    @classmethod
+    def _get_union_extent(cls, bboxes, size):
+        '''
+        :return: 包含所有框的最小水平框(x_min, y_min, x_max, y_max)，与画布取并；没有框时为(w, h, 0, 0)
+        '''
+        extents = cls._get_extents(bboxes)
+        if not len(extents):
+            return size[0], size[1], 0, 0
+        return (min(float(extents[:, 0].min()), size[0]), min(float(extents[:, 1].min()), size[1]),
+                max(float(extents[:, 2].max()), 0), max(float(extents[:, 3].max()), 0))
 
-        if 0 < sed < 0.33:  # 0.33的概率水平翻转，0.33的概率垂直翻转,0.33是对角反转
-            flip_img = cv2.flip(flip_img, 0)  # _flip_x
-            inver = 0
-        elif 0.33 < sed < 0.66:
-            flip_img = cv2.flip(flip_img, 1)  # _flip_y
-            inver = 1
+    def _transform_bboxes(self, bboxes, matrix):
+        '''
+        用仿射矩阵一次性变换全部框
+        keep_quad为True时,变换每个框的四个角点,得到(N, 8)的四边形;
+        否则输出(N, 4)的水平框:水平框输入与原旋转做法一致,取四条边的中点变换后的外接矩形,旋转时不会像四个角点那样把框撑大,
+        平移、翻转时结果与直接变换两个角点相同;四边形输入取四个角点变换后的外接矩形
+        输入:
+            bboxes:(N, 4)或(N, 8)
+            matrix:3x3仿射矩阵
+        输出:
+            变换后的bounding box坐标array
+        '''
+        boxes = self._as_boxes(bboxes)
+        if boxes.shape[1] == 8:
+            points = boxes.reshape(-1, 4, 2)
+        elif self.keep_quad:
+            # 左上、右上、右下、左下四个角点
+            points = boxes[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 4, 2)
         else:
-            flip_img = cv2.flip(flip_img, -1)  # flip_x_y
-            inver = -1
-
-        # 调整boundingbox
-        flip_bboxes = list()
-        for box in bboxes:
-            x_min = box[0]
-            y_min = box[1]
-            x_max = box[2]
-            y_max = box[3]
-
-            if inver == 0:
-                # 0：垂直翻转
-                flip_bboxes.append([x_min, h - y_max, x_max, h - y_min])
-            elif inver == 1:
-                # 1：水平翻转
-                flip_bboxes.append([w - x_max, y_min, w - x_min, y_max])
-            elif inver == -1:
-                # -1：水平垂直翻转
-                flip_bboxes.append([w - x_max, h - y_max, w - x_min, h - y_min])
-        return flip_img, flip_bboxes
+            x_min, y_min, x_max, y_max = boxes.T
+            x_mid, y_mid = (x_min + x_max) / 2, (y_min + y_max) / 2
+            # (N, 4, 2)：上、右、下、左四条边的中点
+            points = np.stack([x_mid, y_min, x_max, y_mid, x_mid, y_max, x_min, y_mid], axis=1).reshape(-1, 4, 2)
+        points = points @ matrix[:2, :2].T + matrix[:2, 2]
+        if self.keep_quad:
+            return points.reshape(-1, 8)
+        return np.concatenate([points.min(axis=1), points.max(axis=1)], axis=1)
+
+    @staticmethod
+    def _get_flip_code(matrix, size):
+        '''
+        :return: 矩阵恰好是整幅图的翻转(或不变)时,返回对应的cv2.flip参数(None表示不变);否则返回False
+        '''
+        w, h = size
+        for flip_code, flip_matrix in ((None, np.eye(3)),
+                                       (0, [[1, 0, 0], [0, -1, h], [0, 0, 1]]),
+                                       (1, [[-1, 0, w], [0, 1, 0], [0, 0, 1]]),
+                                       (-1, [[-1, 0, w], [0, -1, h], [0, 0, 1]])):
+            if np.allclose(matrix, flip_matrix, rtol=0, atol=1e-9):
+                return flip_code
+        return False
+
+    def _warp_img(self, img, matrix, size, interpolation=None):
+        '''
+        按仿射矩阵重采样一次图像
+        输入:
+            img:图像array
+            matrix:3x3仿射矩阵(连续坐标)
+            size:输出画布(w,h)
+            interpolation:插值方法,默认cv2.INTER_LANCZOS4;mask、ID图等标签图应使用cv2.INTER_NEAREST
+        输出:
+            变换后的图像array(新数组)
+        '''
+        import cv2
+
+        flip_code = self._get_flip_code(matrix, size) if size == (img.shape[1], img.shape[0]) else False
+        if flip_code is None:
+            return img.copy()
+        if flip_code is not False:
+            # 纯翻转不需要插值
+            return cv2.flip(img, flip_code)
+        # 矩阵基于连续坐标（像素i覆盖[i, i+1)），warpAffine以像素中心为整数坐标，两者相差半个像素
+        pixel_matrix = self._get_translate_matrix(-0.5, -0.5) @ matrix @ self._get_translate_matrix(0.5, 0.5)
+        return cv2.warpAffine(img, pixel_matrix[:2], size,
+                              flags=cv2.INTER_LANCZOS4 if interpolation is None else interpolation)
+
+    def _warp_img_bboxes(self, img, bboxes, matrix, size):
+        '''
+        按合并后的仿射矩阵只重采样一次图像,并用同一矩阵变换全部框
+        输入:
+            img:图像array
+            bboxes:(N, 4)或(N, 8)
+            matrix:3x3仿射矩阵(连续坐标)
+            size:输出画布(w,h)
+        输出:
+            变换后的图像array与bounding box坐标array
+        '''
+        return self._warp_img(img, matrix, size), self._transform_bboxes(bboxes, matrix)
 
     # 图像增强方法
-    def dataAugment(self, img, bboxes):
+    def dataAugment(self, img, bboxes, rng=random):
+        '''
+        图像增强,见augment_with_maps
+        输出:
+            img:增强后的图像
+            bboxes:增强后图片对应的box,keep_quad为True时为(N, 8)数组,否则为(N, 4)数组
+        '''
+        img, bboxes, _ = self.augment_with_maps(img, bboxes, (), rng)
+        return img, bboxes
+
+    def augment_with_maps(self, img, bboxes, label_maps=(), rng=random):
         '''
-        图像增强
+        图像增强。旋转、平移、翻转先合并为一个仿射矩阵,整幅图只插值一次,框也只变换一次;之后再做亮度、噪声与cutout
         输入:
             img:图像array
-            bboxes:该图像的所有框坐标
+            bboxes:该图像的所有框坐标,(N, 4)的水平框或(N, 8)的四边形,list或array均可
+            label_maps:与图像同尺寸的标签图(如mask、instance-ID图)列表,只做与图像相同的几何变换(最近邻插值)
+            rng:随机数生成器(random.Random),全部随机选择都从中抽取。默认使用random模块的全局状态
         输出:
             img:增强后的图像
-            bboxes:增强后图片对应的box
-        '''
-        change_num = 0  # 改变的次数
-        # print('------')
-        while change_num < 1:  # 默认至少有一种数据增强生效
-
-            if self.is_rotate_img_bbox:
-                if random.random() > self.rotation_rate:  # 旋转
-                    change_num += 1
-                    angle = random.uniform(-self.max_rotation_angle, self.max_rotation_angle)
-                    scale = random.uniform(0.7, 0.8)
-                    img, bboxes = self._rotate_img_bbox(img, bboxes, angle, scale)
-
-            if self.is_shift_pic_bboxes:
-                if random.random() < self.shift_rate:  # 平移
-                    change_num += 1
-                    img, bboxes = self._shift_pic_bboxes(img, bboxes)
-
-            if self.is_changeLight:
-                if random.random() > self.change_light_rate:  # 改变亮度
-                    change_num += 1
-                    img = self._changeLight(img)
-
-            if self.is_addNoise:
-                if random.random() < self.add_noise_rate:  # 加噪声
-                    change_num += 1
-                    img = self._addNoise(img)
-            if self.is_cutout:
-                if random.random() < self.cutout_rate:  # cutout
-                    change_num += 1
-                    img = self._cutout(img, bboxes, length=self.cut_out_length, n_holes=self.cut_out_holes,
-                                       threshold=self.cut_out_threshold)
-            if self.is_filp_pic_bboxes:
-                if random.random() < self.flip_rate:  # 翻转
-                    change_num += 1
-                    img, bboxes = self._filp_pic_bboxes(img, bboxes)
+            bboxes:增强后图片对应的box,keep_quad为True时为(N, 8)数组,否则为(N, 4)数组
+            label_maps:增强后的标签图列表
+        '''
+        import cv2
+
+        bboxes = self._as_boxes(bboxes)
+        is_rotate = is_shift = is_change_light = is_add_noise = is_cutout = is_flip = False
+        while not (is_rotate or is_shift or is_change_light or is_add_noise or is_cutout or is_flip):
+            # 默认至少有一种数据增强生效
+            is_rotate = self.is_rotate_img_bbox and rng.random() < self.rotation_rate  # 旋转
+            is_shift = self.is_shift_pic_bboxes and rng.random() < self.shift_rate  # 平移
+            is_change_light = self.is_changeLight and rng.random() < self.change_light_rate  # 改变亮度
+            is_add_noise = self.is_addNoise and rng.random() < self.add_noise_rate  # 加噪声
+            is_cutout = self.is_cutout and rng.random() < self.cutout_rate  # cutout
+            is_flip = self.is_filp_pic_bboxes and rng.random() < self.flip_rate  # 翻转
+
+        # 几何变换：依次右乘得到合并后的矩阵，平移范围按此前变换后的框计算
+        matrix = np.eye(3)
+        size = (img.shape[1], img.shape[0])
+        if is_rotate:
+            angle = rng.uniform(-self.max_rotation_angle, self.max_rotation_angle)
+            scale = rng.uniform(0.7, 0.8)
+            matrix, size = self._get_rotate_matrix(size, angle, scale)
+        if is_shift:
+            matrix = self._get_shift_matrix(size, self._transform_bboxes(bboxes, matrix), rng) @ matrix
+        if is_flip:
+            matrix = self._get_flip_matrix(size, rng) @ matrix
+        if is_rotate or is_shift or is_flip:
+            img, bboxes = self._warp_img_bboxes(img, bboxes, matrix, size)
+            label_maps = [self._warp_img(label_map, matrix, size, cv2.INTER_NEAREST) for label_map in label_maps]
+        else:
+            # 没有几何变换时也统一框的输出格式；像素级变换原地进行，不能改动调用方的原图
+            img = img.copy()
+            bboxes = self._transform_bboxes(bboxes, matrix)
 
-        return img, bboxes
+        # 像素级变换，均在img上原地进行
+        if is_change_light:
+            img = self._changeLight(img, rng)
+        if is_add_noise:
+            img = self._addNoise(img, rng)
+        if is_cutout:
+            img = self._cutout(img, bboxes, length=self.cut_out_length, n_holes=self.cut_out_holes,
+                               threshold=self.cut_out_threshold, rng=rng)
+        return img, bboxes, list(label_maps)
 
 
 # xml解析工具
@@ -426,8 +520,21 @@ class ToolHelper():
             coords.append([x_min, y_min, x_max, y_max, name])
         return coords
 
+    # 保存DOTA格式的四边形标注
+    def save_dota_txt(self, file_name, save_folder, labels, quads):
+        '''
+        :param labels: 每个框的标签
+        :param quads: (N, 8)，每行为[x1, y1, ..., x4, y4]
+        每行写出"x1 y1 x2 y2 x3 y3 x4 y4 类别 difficult"
+        '''
+        with open(os.path.join(save_folder, file_name), 'w') as f:
+            for label, quad in zip(labels, quads):
+                f.write(' '.join(f"{v:.1f}" for v in quad) + f" {label} 0\n")
+
     # 保存图片结果
     def save_img(self, file_name, save_folder, img):
+        import cv2
+
         cv2.imwrite(os.path.join(save_folder, file_name), img)
 
     # 保持xml结果
@@ -440,6 +547,8 @@ class ToolHelper():
         :param channel:通道
         :return:
         '''
+        from lxml import etree, objectify
+
         folder_name, img_name = img_info  # 得到图片的信息
 
         E = objectify.ElementMaker(annotate=False)
@@ -478,66 +587,190 @@ class ToolHelper():
         etree.ElementTree(anno_tree).write(os.path.join(save_folder, file_name), pretty_print=True)
 
 
-if __name__ == '__main__':
-
-    need_aug_num = 5  # 每张图片需要增强的次数
+# 每个进程内共享的增强上下文，由init_aug_worker设置
+_AUG_CTX = {}
 
-    is_endwidth_dot = True  # 文件是否以.jpg或者png结尾
 
-    dataAug = DataAugmentForObjectDetection()  # 数据增强工具类
-
-    toolhelper = ToolHelper()  # 工具
-
-    # 获取相关参数
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('--source_img_path', type=str, default='data/MSCOCO_train_img')
     parser.add_argument('--source_xml_path', type=str, default='data/MSCOCO_train_xml')
     parser.add_argument('--save_img_path', type=str, default='data/Images2')
     parser.add_argument('--save_xml_path', type=str, default='data/Annotations2')
-    args = parser.parse_args()
-    source_img_path = args.source_img_path  # 图片原始位置
-    source_xml_path = args.source_xml_path  # xml的原始位置
-
-    save_img_path = args.save_img_path  # 图片增强结果保存文件
-    save_xml_path = args.save_xml_path  # xml增强结果保存文件
-
-    # 如果保存文件夹不存在就创建
-    if not os.path.exists(save_img_path):
-        os.mkdir(save_img_path)
+    parser.add_argument('--need_aug_num', type=int, default=5,
+                        help='每张图片需要增强的次数')
+    parser.add_argument('--rotation_rate', type=float, default=0.5, help='旋转的概率')
+    parser.add_argument('--max_rotation_angle', type=float, default=5, help='最大旋转角度')
+    parser.add_argument('--shift_rate', type=float, default=0.5, help='平移的概率')
+    parser.add_argument('--change_light_rate', type=float, default=0.5, help='调整亮度的概率')
+    parser.add_argument('--add_noise_rate', type=float, default=0.5, help='加高斯噪声的概率')
+    parser.add_argument('--flip_rate', type=float, default=0.5, help='翻转的概率')
+    parser.add_argument('--cutout_rate', type=float, default=0.5, help='cutout的概率')
+    parser.add_argument('--cut_out_length', type=int, default=50, help='cutout正方形区域的边长')
+    parser.add_argument('--cut_out_holes', type=int, default=1, help='cutout区域的个数')
+    parser.add_argument('--cut_out_threshold', type=float, default=0.5,
+                        help='cutout区域与目标框的重叠比例上限，超过时重新选择区域')
+    parser.add_argument('--keep_quad', type=bool, default=False,
+                        help='如果为True，则旋转后保留四边形框，标注以DOTA格式的txt（x1 y1 ... x4 y4 类别 difficult）'
+                             '保存在save_xml_path中，代替VOC xml')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='并行增强的进程数。为0时在主进程内串行增强')
+    parser.add_argument('--chunk_size', type=int, default=8,
+                        help='每次分发给一个进程的图片数量')
+    parser.add_argument('--writer_threads', type=int, default=2,
+                        help='每个进程内后台编码、写出增强结果的线程数。为0时同步写出')
+    parser.add_argument('--max_pending_writes', type=int, default=16,
+                        help='每个进程内最多积压的待写出增强结果数量，超出时等待写出，以限制内存占用')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='随机种子。每张增强结果拥有由(seed, 原图文件名, 增强序号)派生的独立随机数流，'
+                             '结果与workers数量无关，可以单独复现任意一张。为None时自动生成并打印')
+    return parser
+
+
+def check_aug_args(args):
+    rates = [args.rotation_rate, args.shift_rate, args.change_light_rate, args.add_noise_rate, args.flip_rate,
+             args.cutout_rate]
+    assert all(0 <= rate <= 1 for rate in rates), "各增强操作的概率需在0-1之间"
+    # dataAugment会一直重试到至少有一种增强生效，全部为0时会死循环
+    assert any(rates), "至少需要有一种增强操作的概率大于0"
+    assert args.need_aug_num > 0, "need_aug_num需大于0"
+
+
+def get_aug_name(file, cnt, label_suffix='.xml'):
+    """
+    :param file: 原图文件名，如"P008.jpg"
+    :param cnt: 增强序号（从0开始）
+    :param label_suffix: 标注文件后缀，VOC xml为".xml"，DOTA txt为".txt"
+    :return: (增强图片文件名, 标注文件名)，如("P008_1.jpg", "P008_1.xml")
+    """
+    dot_index = file.rfind('.')
+    _file_prefix = file[:dot_index]  # 文件名的前缀
+    _file_suffix = file[dot_index:]  # 文件名的后缀
+    return '{}_{}{}'.format(_file_prefix, cnt + 1, _file_suffix), '{}_{}{}'.format(_file_prefix, cnt + 1, label_suffix)
 
-    if not os.path.exists(save_xml_path):
-        os.mkdir(save_xml_path)
 
-    for parent, _, files in os.walk(source_img_path):
+def list_aug_tasks(args):
+    """
+    列出全部需要增强的图片。增强结果（图片与xml）都已存在的增强序号视为已完成，直接跳过，中断后重新运行即可续跑
+    :return: [(原图路径, 原图文件名, 尚未完成的增强序号列表), ...]
+    """
+    done_imgs = set(os.listdir(args.save_img_path)) if os.path.isdir(args.save_img_path) else set()
+    done_xmls = set(os.listdir(args.save_xml_path)) if os.path.isdir(args.save_xml_path) else set()
+    tasks = []
+    for parent, _, files in os.walk(args.source_img_path):
         files.sort()
         for file in files:
-            cnt = 0
-            pic_path = os.path.join(parent, file)
-            xml_path = os.path.join(source_xml_path, file[:-4] + '.xml')
-            values = toolhelper.parse_xml(xml_path)  # 解析得到box信息，格式为[[x_min,y_min,x_max,y_max,name]]
-            coords = [v[:4] for v in values]  # 得到框
-            labels = [v[-1] for v in values]  # 对象的标签
-
-            # 如果图片是有后缀的
-            if is_endwidth_dot:
-                # 找到文件的最后名字
-                dot_index = file.rfind('.')
-                _file_prefix = file[:dot_index]  # 文件名的前缀
-                _file_suffix = file[dot_index:]  # 文件名的后缀
-            img = cv2.imread(pic_path)
-
-            # show_pic(img, coords)  # 显示原图
-            while cnt < need_aug_num:  # 继续增强
-                auged_img, auged_bboxes = dataAug.dataAugment(img, coords)
-                auged_bboxes_int = np.array(auged_bboxes).astype(np.int32)
-                height, width, channel = auged_img.shape  # 得到图片的属性
-                img_name = '{}_{}{}'.format(_file_prefix, cnt + 1, _file_suffix)  # 图片保存的信息
-                toolhelper.save_img(img_name, save_img_path,
-                                    auged_img)  # 保存增强图片
-
-                toolhelper.save_xml('{}_{}.xml'.format(_file_prefix, cnt + 1),
-                                    save_xml_path, (save_img_path, img_name), height, width, channel,
-                                    (labels, auged_bboxes_int))  # 保存xml文件
-                # show_pic(auged_img, auged_bboxes)  # 强化后的图
-                print(img_name)
-                cnt += 1  # 继续增强下一张
+            todo = []
+            for cnt in range(args.need_aug_num):
+                img_name, xml_name = get_aug_name(file, cnt, '.txt' if args.keep_quad else '.xml')
+                if img_name not in done_imgs or xml_name not in done_xmls:
+                    todo.append(cnt)
+            if todo:
+                tasks.append((os.path.join(parent, file), file, todo))
+    return tasks
+
+
+def init_aug_worker(args):
+    _AUG_CTX['args'] = args
+    _AUG_CTX['data_aug'] = DataAugmentForObjectDetection(
+        rotation_rate=args.rotation_rate, max_rotation_angle=args.max_rotation_angle, shift_rate=args.shift_rate,
+        change_light_rate=args.change_light_rate, add_noise_rate=args.add_noise_rate, flip_rate=args.flip_rate,
+        cutout_rate=args.cutout_rate, cut_out_length=args.cut_out_length, cut_out_holes=args.cut_out_holes,
+        cut_out_threshold=args.cut_out_threshold, keep_quad=args.keep_quad)
+    _AUG_CTX['tool_helper'] = ToolHelper()
+    if args.workers > 0:
+        import cv2
+
+        # 已经按进程并行，每个进程内的OpenCV只用一个线程
+        cv2.setNumThreads(1)
+    import multiprocessing.util
+    from utils.output_tools import AsyncWriter
+
+    _AUG_CTX['writer'] = AsyncWriter(args.writer_threads, args.max_pending_writes)
+    multiprocessing.util.Finalize(None, close_aug_worker, exitpriority=10)
+
+
+def close_aug_worker():
+    if 'writer' in _AUG_CTX:
+        _AUG_CTX['writer'].close()
+
+
+def save_aug_result(tool_helper, args, img_name, xml_name, auged_img, labels, auged_bboxes):
+    """
+    保存一张增强结果。标注最后写入且先写临时文件再重命名，标注存在即说明该结果已完整写出，续跑时据此跳过
+    """
+    height, width, channel = auged_img.shape  # 得到图片的属性
+    tool_helper.save_img(img_name, args.save_img_path, auged_img)
+    tmp_name = f"{xml_name}.{os.getpid()}.tmp"
+    if args.keep_quad:
+        tool_helper.save_dota_txt(tmp_name, args.save_xml_path, labels, auged_bboxes)
+    else:
+        tool_helper.save_xml(tmp_name, args.save_xml_path, (args.save_img_path, img_name), height, width, channel,
+                             (labels, auged_bboxes.astype(np.int32)))
+    os.replace(os.path.join(args.save_xml_path, tmp_name), os.path.join(args.save_xml_path, xml_name))
+
+
+def run_aug_chunk(chunk):
+    """
+    增强一组图片，结果交给后台线程写出
+    :param chunk: [(原图路径, 原图文件名, 增强序号列表), ...]
+    :return: (完成的图片数, 写出的增强结果数)
+    """
+    import cv2
+
+    args = _AUG_CTX['args']
+    num_saved = 0
+    for pic_path, file, todo in chunk:
+        xml_path = os.path.join(args.source_xml_path, file[:-4] + '.xml')
+        values = _AUG_CTX['tool_helper'].parse_xml(xml_path)  # 解析得到box信息，格式为[[x_min,y_min,x_max,y_max,name]]
+        coords = [v[:4] for v in values]  # 得到框
+        labels = [v[-1] for v in values]  # 对象的标签
+        img = cv2.imread(pic_path)
+        for cnt in todo:
+            aug_rng = random.Random(f"{args.seed}-{file}-{cnt}")
+            auged_img, auged_bboxes = _AUG_CTX['data_aug'].dataAugment(img, coords, aug_rng)
+            img_name, xml_name = get_aug_name(file, cnt, '.txt' if args.keep_quad else '.xml')
+            _AUG_CTX['writer'].submit(save_aug_result, _AUG_CTX['tool_helper'], args, img_name, xml_name,
+                                      auged_img, labels, auged_bboxes)
+            num_saved += 1
+    # 返回前写完本组的全部结果，主进程统计到的都是已经落盘的结果
+    _AUG_CTX['writer'].flush()
+    return len(chunk), num_saved
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    check_aug_args(args)
+    if args.seed is None:
+        args.seed = random.SystemRandom().randrange(2 ** 32)
+    print(f"Random seed: {args.seed}")
+    import multiprocessing
+    from tqdm import tqdm
+
+    tasks = list_aug_tasks(args)
+    print(f"{len(tasks)} images to augment")
+    # 有结果要保存时才创建保存文件夹
+    if tasks:
+        os.makedirs(args.save_img_path, exist_ok=True)
+        os.makedirs(args.save_xml_path, exist_ok=True)
+    chunk_size = max(1, args.chunk_size)
+    chunks = [tasks[start:start + chunk_size] for start in range(0, len(tasks), chunk_size)]
+
+    total_saved = 0
+    with tqdm(total=len(tasks)) as pbar:
+        if args.workers > 0:
+            pool = multiprocessing.Pool(args.workers, initializer=init_aug_worker, initargs=(args,))
+            chunk_results = pool.imap_unordered(run_aug_chunk, chunks)
+        else:
+            pool = None
+            init_aug_worker(args)
+            chunk_results = map(run_aug_chunk, chunks)
+        for num_done, num_saved in chunk_results:
+            total_saved += num_saved
+            pbar.update(num_done)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        else:
+            close_aug_worker()
+    print(f"Finished, {total_saved} augmented images saved")
@@ -1,12 +1,6 @@
 import argparse
 import os
 import random
-
-from tqdm import tqdm
-import json
-from utils.normal_tools import *
-from utils.image_tools import *
-from PIL import Image
 import warnings
 
 
@@ -24,15 +18,21 @@ def get_parser():
                         help="如果是在已有目标的图上粘贴新目标，为了防止随机选取粘贴坐标导致的遮挡，可以读取原图的标注数据提取已有bbox"
                              "以防止遮挡，同时可以根据原有物体平均大小自动设定缩放scale，防止物体过大/过小"
                              "json格式见example/example_bg_data.json。可以为None")
+    parser.add_argument("--lazy_bg_json", type=bool, default=False,
+                        help="如果为True，则只流式扫描一遍bg_json建立索引，每张背景的标注在用到时才读取。"
+                             "适合无法一次性读入内存的超大标注文件")
+    parser.add_argument("--bg_json_cache", type=bool, default=False,
+                        help="如果为True，则第一次运行时将bg_json转换为二进制缓存（json同目录下的.bgcache.bin与.bgcache.jsonl），"
+                             "之后的运行直接内存映射其中的bbox，不再解析json；json有改动时自动重建。优先于lazy_bg_json")
     parser.add_argument("--manual_scaling", type=bool, default=False,
                         help="如果为False，默认尝试读取原数据json自动获取scaling，只有找不到json才使用设定缩放比例；"
                              "如果为True，则强制使用人工设定的缩放上下限")
     parser.add_argument("--min_scaling_factor", type=float, default=0.1,
                         help="设定每张图片上放置目标的缩放比例下限（0-1）。"
-                             "若为1，则代表instance的长/宽此时与背景长/宽相等（以先到达100%者为准")
+                             "若为1，则代表instance的长/宽此时与背景长/宽相等（以先到达100%%者为准")
     parser.add_argument("--max_scaling_factor", type=float, default=0.15,
                         help="设定每张图片上放置目标的缩放比例下限（0-1）"
-                             "若为1，则代表instance的长/宽此时与背景长/宽相等（以先到达100%者为准")
+                             "若为1，则代表instance的长/宽此时与背景长/宽相等（以先到达100%%者为准")
     parser.add_argument("--no_ins_mask", type=bool, default=False,
                         help="如果为True，则确定没有instance masks，paste时不会使用mask，而是直接整个贴上去")
     parser.add_argument("--ins_dominant", type=bool, default=False,
@@ -47,20 +47,115 @@ def get_parser():
     parser.add_argument("--classes_for_autoscaling", type=list, default=None,
                         help="一个列表，指定参考哪些类的大小作为自动缩放参照。"
                              "比如想要粘贴小汽车目标，应参考small-vehicle而非airport的大小")
+    parser.add_argument("--autoscaling_mode", default="mean", choices=['mean', 'median', 'sample'],
+                        help="自动缩放时参照尺寸的取法。mean：参照类别全部bbox的平均宽高；median：宽高的中位数；"
+                             "sample：每个instance从参照类别的bbox中随机抽取一个作为参照，缩放后的尺寸服从背景上真实的尺寸分布")
+    parser.add_argument("--placement_method", default="grid", choices=['grid', 'random'],
+                        help="寻找不重叠粘贴坐标的方法。grid：先少量随机尝试，失败时在占用栅格上从所有合法坐标中均匀抽取，"
+                             "耗时有上限，与背景上目标多少无关；random：随机尝试坐标直到不重叠（拒绝采样）")
     parser.add_argument("--max_attempt_finding_xy", type=int, default=1000000,
-                        help="寻找不重叠的粘贴坐标时，最大允许的尝试次数。避免死循环。若找不到则跳过这个instance")
+                        help="placement_method为random时，寻找不重叠的粘贴坐标最大允许的尝试次数。避免死循环。"
+                             "若找不到则跳过这个instance")
+    parser.add_argument("--overlap_tolerance", type=float, default=None,
+                        help="placement_method为random时，允许新目标与已有目标重叠的程度（0-1）。"
+                             "为None时使用严格规则，边界接触也视为重叠")
+    parser.add_argument("--overlap_metric", default="ioa", choices=['ioa', 'iou'],
+                        help="overlap_tolerance对应的重叠计算方式。ioa：交集占两框中较小者面积的比例；iou：交并比")
     parser.add_argument("--resample_method", default="LANCZOS", choices=['LANCZOS', 'BILINEAR', 'BICUBIC'],
                         help="图像缩放时的插值方法")
+    parser.add_argument("--resize_backend", default="pil", choices=['pil', 'cv2'],
+                        help="instance缩放后端。pil：instance与mask分别用PIL缩放；cv2：instance与mask合并为一个多通道数组，"
+                             "由OpenCV一次缩放（缩小时使用INTER_AREA），速度快数倍，结果与pil略有差异")
+    parser.add_argument("--instance_cache_mb", type=int, default=1024,
+                        help="每个进程缓存已解码instance图片与mask的内存上限（MB），超出时淘汰最久未使用的instance。为0时不缓存")
+    parser.add_argument("--instance_pyramid_levels", type=int, default=0,
+                        help="缓存instance时额外保存的逐级缩小一半的版本数。大于0时缩放会从最接近目标尺寸的一级开始，"
+                             "速度更快，但结果与直接从原图缩放略有差异")
+    parser.add_argument("--bg_cache_mb", type=int, default=1024,
+                        help="gen_num模式下缓存已解码背景图的内存上限（MB），所有进程共享同一份缓存。为0时不缓存")
+    parser.add_argument("--bg_cache_dir", type=str, default=None,
+                        help="背景缓存文件存放位置。为None时优先使用/dev/shm共享内存，运行结束后自动删除")
+    parser.add_argument("--index_offset", type=int, default=0,
+                        help="输出文件编号的偏移量。多个任务的输出需要合并到一起时，可为每个任务设置不重叠的编号范围。"
+                             "合成图的随机数流由(seed, 全局编号)决定，因此用相同seed、index_offset=已完成数量即可续跑；"
+                             "index_offset=N、gen_num=1即可单独重新生成第N+1张合成图")
+    parser.add_argument("--shard_size", type=int, default=0,
+                        help="大于0时，输出文件按编号每shard_size个放入一个子文件夹（如composites/00000/），"
+                             "避免单个文件夹内文件过多。为0时不分子文件夹")
+    parser.add_argument("--image_format", default="png", choices=['png', 'jpg', 'webp'],
+                        help="合成图保存格式")
+    parser.add_argument("--image_quality", type=int, default=95,
+                        help="image_format为jpg或webp时的保存质量（1-100）")
+    parser.add_argument("--png_compress_level", type=int, default=6,
+                        help="png压缩等级（0-9）。越小编码越快，文件越大")
+    parser.add_argument("--mask_mode", default="RGB", choices=['RGB', 'L', '1'],
+                        help="合成图mask的保存模式。RGB：三通道；L：单通道灰度；1：1位二值图。mask始终保存为png")
+    parser.add_argument("--id_masks", type=bool, default=False,
+                        help="如果为True，则在masks文件夹下额外输出instance-ID图（_ids.png，16位灰度，像素值为json中"
+                             "pasted_instances的instance_id）与类别ID图（_cls.png，8位灰度，像素值为类别在yolo_class_list中的"
+                             "下标加1），0均为背景。粘贴时同步写入，无需再做连通域分析")
+    parser.add_argument("--rle_masks", type=bool, default=False,
+                        help="如果为True，则json的pasted_instances中为每个粘贴的instance附带COCO格式的未压缩RLE mask"
+                             "（已去除被遮挡部分）")
+    parser.add_argument("--instance_flip_rate", type=float, default=0,
+                        help="每个instance粘贴前水平翻转的概率")
+    parser.add_argument("--instance_light_rate", type=float, default=0,
+                        help="每个instance粘贴前随机调暗（系数0.35-1）的概率")
+    parser.add_argument("--instance_rotation_rate", type=float, default=0,
+                        help="每个instance粘贴前旋转的概率。旋转后的bbox为四边形，多出的角落为透明")
+    parser.add_argument("--instance_max_rotation_angle", type=float, default=15,
+                        help="instance旋转的最大角度")
+    parser.add_argument("--composite_aug", type=bool, default=False,
+                        help="如果为True，则对拼好的每张合成图在内存中做一次augmentation.py中的增强（旋转缩放、平移、翻转、"
+                             "亮度、噪声，不含cutout），全部bbox、mask与ID图同步变换，不经过中间文件")
+    parser.add_argument("--composite_max_rotation_angle", type=float, default=5,
+                        help="composite_aug为True时，合成图旋转的最大角度")
+    parser.add_argument("--output_layout", default="files", choices=['files', 'tar'],
+                        help="输出组织方式。files：每张合成图的图片、mask、json、yolo标签分别存为单独文件；"
+                             "tar：WebDataset风格，同一张合成图的全部输出写入同一个tar分片（output/时间戳/shards），"
+                             "附带索引，可按样本随机读取或顺序流式读取（见output_tools.TarShardReader）")
+    parser.add_argument("--tar_shard_mb", type=int, default=1024,
+                        help="output_layout为tar时，单个分片的大小上限（MB）")
+    parser.add_argument("--writer_threads", type=int, default=2,
+                        help="每个进程内后台编码、写出合成图与标注的线程数。为0时在生成循环内同步写出")
+    parser.add_argument("--max_pending_writes", type=int, default=8,
+                        help="每个进程内最多积压的待写出合成图数量，超出时生成循环等待写出，以限制内存占用")
     parser.add_argument("--yolo_class_list", type=list,
                         default=['car', 'truck', 'tank', 'armored_car', 'radar', 'artillery'])
     parser.add_argument("--motion_mode", type=bool, default=False,
                         help="是否生成有规律运动的目标，只允许有一个物体")
     parser.add_argument("--controlnet_gen_data", type=bool, default=True,
                         help="controlnet生成数据时，文件夹格式有所不同，mask映射关系也会改变")
+    parser.add_argument("--refresh_catalog", type=bool, default=False,
+                        help="如果为True，则忽略project_folder下已保存的instance目录（instance_catalog.json），重新扫描全部instance")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="并行生成合成图的进程数。为0时在主进程内串行生成")
+    parser.add_argument("--chunk_size", type=int, default=16,
+                        help="每个任务块包含的合成图数量，只影响调度粒度，不影响输出结果")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="随机种子。每张合成图拥有由(seed, 全局编号)派生的独立随机数流，固定seed时输出结果与workers数量、"
+                             "chunk_size无关。为None时自动生成并打印，便于复现")
     args = parser.parse_args()
     return args
 
 
+def check_args(args):
+    """
+    在加载任何图像处理模块、创建任何输出文件夹之前检查参数，参数有误时立即退出
+    """
+    if args.ins_dominant:
+        raise NotImplementedError
+    assert 0 < args.min_scaling_factor <= args.max_scaling_factor <= 1
+    assert args.overlap_tolerance is None or args.placement_method == 'random', \
+        "overlap_tolerance仅在placement_method为random时生效"
+    assert args.min_num_ins_per_bg <= args.max_num_ins_per_bg
+    assert not args.id_masks or len(args.yolo_class_list) < 256, "类别ID图为8位，最多支持255个类别"
+    assert all(0 <= rate <= 1 for rate in (args.instance_flip_rate, args.instance_light_rate,
+                                           args.instance_rotation_rate)), "instance增强的概率需在0-1之间"
+    assert 0 <= args.png_compress_level <= 9, "png_compress_level需在0-9之间"
+    assert 1 <= args.image_quality <= 100, "image_quality需在1-100之间"
+
+
 if __name__ == '__main__':
     """
     project_folder下文件格式：
@@ -79,14 +174,37 @@ if __name__ == '__main__':
                                     |---...（图片）
                                 |---labels
 
-    json格式参考example_bg_data.json。需要注意，如果列表中某个dict内没有“img_class”一项，检索该图片时则会在backgrounds文件夹内遍历，
-    如果有重名情况可能会找到错误的图片
+    json格式参考example_bg_data.json。需要注意，backgrounds文件夹不分类别，标注只按img_name检索，
+    如果json中有重名的图片，使用第一次出现的标注（加载时会给出警告）
 
     默认情况下，目标图像多，背景图像少。在每张背景图上随机放置给定数量上下限内的目标图像（两张合成图内，目标可能重复）。
     其他情况下的合成正在实现
     """
     args = get_parser()
+    check_args(args)
+    # 参数确认无误后才加载生成所需的模块，--help与参数检查不必导入PIL、NumPy等
+    import multiprocessing
+    import shutil
+    import tempfile
+    import uuid
+    from collections import Counter
+    from datetime import datetime
+
+    from tqdm import tqdm
+
+    from utils.annotation_tools import BgAnnotationIndex
+    from utils.catalog_tools import InstanceCatalog
+    from utils.composite_tools import close_worker, init_worker, run_chunk
+    from utils.image_tools import generate_motion_path
+    from utils.normal_tools import CompositeNameAllocator, get_folders, get_format_beijing_time
+    from utils.output_tools import OutputEncoding, RunMetadata
+
     time_now = get_format_beijing_time()
+    # 输出文件夹名在时间戳后加上随机的运行ID，同一秒启动的多个任务不会写入同一文件夹、互相覆盖
+    run_name = f"{time_now}-{uuid.uuid4().hex[:8]}"
+    if args.seed is None:
+        args.seed = random.SystemRandom().randrange(2 ** 32)
+    print(f"Random seed: {args.seed}")
 
     # 目标图片文件名要和相应的mask文件名有对应关系，如instance图片文件名“P008.png”，
     # 对应mask图片命名需要同样是“P008.png”，或“P008_mask.png”（mask后缀名随意，可以为png、jpg或jpeg，无需对应）
@@ -94,230 +212,109 @@ if __name__ == '__main__':
     (bg_folder, ins_folder_list, ins_mask_folder_list,
      composite_save_folder, comp_mask_save_folder, composite_label_folder) = get_folders(
         args.project_folder,
-        time_now,
+        run_name,
         args.ins_category,
         args.no_ins_mask
     )
 
-    # 得到全部目标图片路径和背景文件路径，同时分别计数
-    # 如果是controlnet合成数据，instances/{装备类型}/images 文件夹下，每张图片都有一个单独的文件夹.
-    # 同时还会有canny.jpg这样的不需要的数据，需要予以剔除
-    if args.controlnet_gen_data:
-        ins_path_list = []
-        for ins_folder in ins_folder_list:
-            for ctrl_image_folder in os.listdir(ins_folder):
-                if "pipe_config" in ctrl_image_folder:  # 排除pipe_config文件夹
-                    continue
-                for file in os.listdir(os.path.join(ins_folder, ctrl_image_folder)):
-                    if "canny" in file:  # 排除canny.jpg等文件
-                        continue
-                    ins_path_list.append(os.path.join(ins_folder, ctrl_image_folder, file))
-        ins_num = len(ins_path_list)
-    else:
-        ins_path_list = []
-        # ins_folder_list: 所有类的images文件夹绝对路径
-        for ins_folder in ins_folder_list:
-            for file in os.listdir(ins_folder):
-                ins_path_list.append(os.path.join(ins_folder, file))
-        ins_num = len(ins_path_list)
-
-    bg_path_list = [os.path.join(bg_folder, file) for file in os.listdir(bg_folder)]
-    bg_num = len(bg_path_list)
+    # 得到全部目标图片路径及其元数据。instance目录持久化保存在project_folder下，
+    # 只有新增或改动过的instance需要重新读取，启动时不必再遍历、解码全部instance
+    catalog = InstanceCatalog.load_or_build(args.project_folder, ins_folder_list, args.controlnet_gen_data,
+                                            refresh=args.refresh_catalog)
+    # 已排序，保证固定seed时结果可复现
+    ins_path_list = catalog.ins_path_list
+    # 启动时一次性匹配所有instance的mask，缺失的mask在此处报告，而不是运行到一半才发现
+    ins_mask_map = {}
+    if not args.no_ins_mask:
+        ins_mask_map = catalog.get_mask_map()
+        unmatched_ins = [path for path in ins_path_list if ins_mask_map[path] is None]
+        if unmatched_ins:
+            # controlnet数据以instance所在文件夹名匹配mask
+            unmatched_names = "、".join(
+                os.path.basename(os.path.dirname(path) if args.controlnet_gen_data else path)
+                for path in unmatched_ins[:10])
+            if args.controlnet_gen_data:
+                raise FileNotFoundError(f"{len(unmatched_ins)}张instance图片的mask未找到，如：{unmatched_names}")
+            warnings.warn(f"{len(unmatched_ins)}张instance图片找不到对应的mask，将直接整张粘贴，如：{unmatched_names}",
+                          UserWarning)
+    bg_path_list = sorted(os.path.join(bg_folder, file) for file in os.listdir(bg_folder))
 
     # 如果是在已有标注的数据上paste，读取原始背景中的数据
-    # if args.bg_json_path is not None:
-    original_data = []
+    # 加载时建立一次按图片名检索的索引，避免每张合成图都遍历全部标注
+    bg_annotations = None
     if args.bg_json_path:
         if os.path.exists(args.bg_json_path):
-            with open(args.bg_json_path, 'r') as f:
-                original_data = json.load(f)  # 背景图片对应json里的原始数据
-            assert original_data
-    # 开始合成
-    used_bg = used_ins = 0
+            bg_annotations = BgAnnotationIndex(args.bg_json_path, lazy=args.lazy_bg_json, cache=args.bg_json_cache)
+            assert len(bg_annotations)
 
-    if args.ins_dominant:
-        raise NotImplementedError
+    if args.gen_num <= 0:
+        # 该模式下，有多少个背景图片就生成多少张合成图。
+        total_num = len(bg_path_list)
+        print(f"Walking through all {total_num} images.")
     else:
-        if args.gen_num <= 0:
-            # 该模式下，有多少个背景图片就生成多少张合成图。
-            print(f"Walking through all {len(bg_path_list)} images.")
-            for bg_path in tqdm(bg_path_list):
-                bg_img = Image.open(bg_path)
-                ins_num_per_bg = random.randint(args.min_num_ins_per_bg, args.max_num_ins_per_bg)
-                selected_ins_path_list = get_some_instances(ins_path_list, ins_num_per_bg)
-                bg_data_dict = new_ins_data_dict = {}
-                final_mask_img = Image.new('RGB', (bg_img.size[0], bg_img.size[1]), (0, 0, 0))
-
-                # 如果存在bg json数据，则读取
-                if original_data:
-                    for one_dict in original_data:  # one_dict：每张图对应的字典，内含img_name、instances、exist_category三个key
-                        if one_dict['img_name'] == os.path.basename(bg_path):
-                            bg_data_dict = one_dict
-                            bg_data_dict['bg_img_info'] = {
-                                'img_name': os.path.basename(bg_path),
-                                'bg_width': bg_img.width,
-                                'bg_height': bg_img.height
-                            }
-                            break
-                else:
-                    bg_data_dict = {
-                        "bg_img_info": {
-                            'img_name': os.path.basename(bg_path),
-                            'bg_width': bg_img.width,
-                            'bg_height': bg_img.height
-                        },
-                        'instances': {},
-                        'exist_category': []
-                    }
-                have_at_least_one_instance = False  # 防止极端情况下一个合适的坐标都没找到，而生成无目标图
-                for ins_path in selected_ins_path_list:
-                    ins_mask_path = get_ins_mask_dir(ins_path)
-                    ins_img = Image.open(ins_path)
-                    ins_mask_img = Image.open(ins_mask_path).convert("L") if (
-                            ins_mask_path and not args.no_ins_mask) else None
-                    scaled_ins_img, scaled_ins_mask_img = get_scaled_image(
-                        ins_img, ins_mask_img, bg_img, args, bg_data_dict)
-                    if args.no_ins_mask:
-                        scaled_ins_mask_img = None
-                    existing_bounding_boxes = bg_data_dict['instances'] if bg_data_dict['instances'] else {}
-                    x, y = find_non_overlapping_position(scaled_ins_img.size, bg_img.size,
-                                                         existing_bounding_boxes, args.max_attempt_finding_xy)
-
-                    # 准备粘贴
-                    if x is None or y is None:
-                        continue
-                    else:
-                        bg_img, bbox = paste_img_or_mask(scaled_ins_img, bg_img, (x, y), scaled_ins_mask_img)
-                        final_mask_img, _ = paste_img_or_mask(scaled_ins_mask_img, final_mask_img, (x, y))
-                        ins_class_name = os.path.basename(os.path.dirname(os.path.dirname(ins_path)))
-                        if ins_class_name in bg_data_dict['instances'].keys():
-                            bg_data_dict['instances'][ins_class_name].append(bbox)
-                        else:
-                            bg_data_dict['instances'][ins_class_name] = [bbox]
-                            bg_data_dict['exist_category'].append(ins_class_name)
-
-                        have_at_least_one_instance = True
-                if have_at_least_one_instance:
-                    # 将时间戳转化为月份日期格式。如"1227"
-                    datetime_obj = datetime.strptime(time_now, "%Y-%m-%d-%H-%M-%S")
-                    month_date_str = datetime_obj.strftime("%m%d")
-
-                    saved_img_num = len(os.listdir(composite_save_folder))
-                    bg_img.save(
-                        os.path.join(composite_save_folder, f"composite_{month_date_str}_{str(saved_img_num + 1)}.png"))
-                    if args.no_ins_mask:
-                        final_mask_img.save(os.path.join(
-                            comp_mask_save_folder,
-                            f"composite_{month_date_str}_{str(saved_img_num + 1)}_mask.png")
-                        )
-                    os.makedirs(os.path.join(composite_label_folder, 'json'), exist_ok=True)
-                    os.makedirs(os.path.join(composite_label_folder, 'yolo_txt'), exist_ok=True)
-                    with open(os.path.join(
-                            composite_label_folder, 'json',
-                            f"composite_{month_date_str}_{str(saved_img_num + 1)}.json"), 'w') as f:
-                        json.dump(bg_data_dict, f, indent=4)
-
-                    json_to_yolov8(bg_data_dict, os.path.join(composite_label_folder, 'yolo_txt',
-                                                              f"composite_{month_date_str}_{str(saved_img_num + 1)}.txt"),
-                                   args.yolo_class_list)
-                else:
-                    warnings.warn(f"背景图 {os.path.basename(bg_path)} 中难以粘贴合适的instance，请留意（该图像未保存）",
-                                  UserWarning)
-        else:
-            print(f"Generating {args.gen_num} images, as set in args.gen_num")
-            if args.motion_mode:  # 如果需要生成有轨迹运动的图片的话（目标数量只能为1）
-                motion_path_coor = generate_motion_path(args.gen_num)
-            for ii in tqdm(range(args.gen_num)):
-                bg_path = random.choice(bg_path_list)
-                bg_img = Image.open(bg_path)
-                ins_num_per_bg = random.randint(args.min_num_ins_per_bg, args.max_num_ins_per_bg)
-                selected_ins_path_list = get_some_instances(ins_path_list, ins_num_per_bg)
-                bg_data_dict = new_ins_data_dict = {}
-                final_mask_img = Image.new('RGB', (bg_img.size[0], bg_img.size[1]), (0, 0, 0))
-
-                # 如果存在bg json数据，则读取
-                if original_data:
-                    for one_dict in original_data:  # one_dict：每张图对应的字典，内含img_name、instances、exist_category三个key
-                        if one_dict['img_name'] == os.path.basename(bg_path):
-                            bg_data_dict = one_dict
-                            bg_data_dict['bg_img_info'] = {
-                                'img_name': os.path.basename(bg_path),
-                                'bg_width': bg_img.width,
-                                'bg_height': bg_img.height
-                            }
-                            break
-                else:
-                    bg_data_dict = {
-                        "bg_img_info": {
-                            'img_name': os.path.basename(bg_path),
-                            'bg_width': bg_img.width,
-                            'bg_height': bg_img.height
-                        },
-                        'instances': {},
-                        'exist_category': []
-                    }
-                have_at_least_one_instance = False  # 防止极端情况下一个合适的坐标都没找到，而生成无目标图
-
-                for ins_path in selected_ins_path_list:
-                    if args.controlnet_gen_data:
-                        ins_mask_path = get_ctrlnet_ins_mask_dir(ins_path)
-                    else:
-                        ins_mask_path = get_ins_mask_dir(ins_path)
-                    ins_img = Image.open(ins_path)
-                    ins_mask_img = Image.open(ins_mask_path).convert("L") if (
-                            ins_mask_path and not args.no_ins_mask) else None
-                    # 中间已经包含着mask与image dimension一致的断言
-                    scaled_ins_img, scaled_ins_mask_img = get_scaled_image(
-                        ins_img, ins_mask_img, bg_img, args, bg_data_dict)
-                    existing_bounding_boxes = bg_data_dict['instances'] if bg_data_dict['instances'] else {}
-                    x, y = find_non_overlapping_position(scaled_ins_img.size, bg_img.size,
-                                                         existing_bounding_boxes, args.max_attempt_finding_xy)
-                    if args.motion_mode:
-                        x = int(motion_path_coor[ii][0])
-                        y = int(motion_path_coor[ii][1])
-                    # 准备粘贴
-                    if x is None or y is None:
-                        continue
-                    else:
-                        bg_img, bbox = paste_img_or_mask(scaled_ins_img, bg_img, (x, y), scaled_ins_mask_img)
-                        if not args.no_ins_mask:
-                            final_mask_img, _ = paste_img_or_mask(scaled_ins_mask_img, final_mask_img, (x, y))
-                        if args.controlnet_gen_data:
-                            ins_class_name = os.path.basename(os.path.dirname(os.path.dirname(os.path.dirname(ins_path))))
-                        else:
-                            ins_class_name = os.path.basename(os.path.dirname(os.path.dirname(ins_path)))
-                        if ins_class_name in bg_data_dict['instances'].keys():
-                            bg_data_dict['instances'][ins_class_name].append(bbox)
-                        else:
-                            bg_data_dict['instances'][ins_class_name] = [bbox]
-                            bg_data_dict['exist_category'].append(ins_class_name)
+        total_num = args.gen_num
+        print(f"Generating {total_num} images, as set in args.gen_num")
 
-                        have_at_least_one_instance = True
-                if have_at_least_one_instance:
-                    # 将时间戳转化为月份日期格式。如"1227"
-                    datetime_obj = datetime.strptime(time_now, "%Y-%m-%d-%H-%M-%S")
-                    month_date_str = datetime_obj.strftime("%m%d")
+    encoding = OutputEncoding(args.image_format, args.image_quality, args.png_compress_level, args.mask_mode)
 
-                    saved_img_num = len(os.listdir(composite_save_folder))
-                    bg_img.save(
-                        os.path.join(composite_save_folder, f"composite_{month_date_str}_{str(saved_img_num + 1)}.png"))
-                    if not args.no_ins_mask:
-                        os.makedirs(comp_mask_save_folder, exist_ok=True)
-                        final_mask_img.save(os.path.join(
-                            comp_mask_save_folder,
-                            f"composite_{month_date_str}_{str(saved_img_num + 1)}_mask.png")
-                        )
-                    os.makedirs(os.path.join(composite_label_folder, 'json'), exist_ok=True)
-                    os.makedirs(os.path.join(composite_label_folder, 'yolo_txt'), exist_ok=True)
-                    with open(os.path.join(
-                            composite_label_folder, 'json',
-                            f"composite_{month_date_str}_{str(saved_img_num + 1)}.json"), 'w') as f:
-                        json.dump(bg_data_dict, f, indent=4)
+    # 将时间戳转化为月份日期格式。如"1227"
+    month_date_str = datetime.strptime(time_now, "%Y-%m-%d-%H-%M-%S").strftime("%m%d")
+    ctx = {
+        'args': args,
+        'seed': args.seed,
+        'ins_path_list': ins_path_list,
+        'ins_mask_map': ins_mask_map,
+        'ins_records': catalog.records,
+        'bg_path_list': bg_path_list,
+        'bg_annotations': bg_annotations,
+        # 如果需要生成有轨迹运动的图片的话（目标数量只能为1）
+        'motion_path_coor': generate_motion_path(args.gen_num) if (args.motion_mode and args.gen_num > 0) else None,
+        'encoding': encoding,
+        # 运行参数在第一张合成图写出时才保存
+        'run_metadata': RunMetadata(os.path.dirname(composite_save_folder), args, encoding),
+        'name_allocator': CompositeNameAllocator(month_date_str, args.index_offset, args.shard_size),
+        'composite_save_folder': composite_save_folder,
+        'comp_mask_save_folder': comp_mask_save_folder,
+        'composite_label_folder': composite_label_folder,
+        'shard_folder': os.path.join(os.path.dirname(composite_save_folder), 'shards')
+        if args.output_layout == 'tar' else None,
+        'bg_cache_dir': None,
+        'bg_cache_bytes': None,
+    }
+    # gen_num模式下背景会被反复抽中，缓存解码结果；各进程通过内存映射共享同一份缓存
+    if args.gen_num > 0 and args.bg_cache_mb > 0:
+        bg_cache_root = args.bg_cache_dir
+        if bg_cache_root is None and os.path.isdir('/dev/shm'):
+            bg_cache_root = '/dev/shm'
+        ctx['bg_cache_dir'] = tempfile.mkdtemp(prefix='copy_paste_bg_cache_', dir=bg_cache_root)
+        ctx['bg_cache_bytes'] = multiprocessing.Value('q', 0)
+    # 按固定大小切分任务块，每块拥有独立的编号范围；主进程只负责调度和进度统计
+    chunk_size = max(1, args.chunk_size)
+    chunks = [list(range(start, min(start + chunk_size, total_num))) for start in range(0, total_num, chunk_size)]
 
-                    json_to_yolov8(bg_data_dict, os.path.join(composite_label_folder, 'yolo_txt',
-                                                              f"composite_{month_date_str}_{str(saved_img_num + 1)}.txt"),
-                                   args.yolo_class_list)
-                else:
-                    warnings.warn(f"背景图 {os.path.basename(bg_path)} 中难以粘贴合适的instance，请留意（该图像未保存）",
-                                  UserWarning)
-    print("Finished")
+    stats = Counter()
+    try:
+        with tqdm(total=total_num) as pbar:
+            if args.workers > 0:
+                pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(ctx,))
+                chunk_results = pool.imap_unordered(run_chunk, chunks)
+            else:
+                pool = None
+                init_worker(ctx)
+                chunk_results = map(run_chunk, chunks)
+            for chunk_stats in chunk_results:
+                stats.update(chunk_stats)
+                pbar.update(chunk_stats['done'])
+            if pool is not None:
+                pool.close()
+                pool.join()
+            else:
+                close_worker()
+    finally:
+        if ctx['bg_cache_dir']:
+            shutil.rmtree(ctx['bg_cache_dir'], ignore_errors=True)
+    for name in ('instance_cache', 'bg_cache'):
+        hits, misses = stats[f'{name}_hits'], stats[f'{name}_misses']
+        if hits or misses:
+            print(f"{name}: {hits} hits, {misses} misses (hit rate {hits / (hits + misses):.1%})")
+    print(f"Finished, {stats['saved']}/{total_num} composites saved")
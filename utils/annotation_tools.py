@@ -0,0 +1,534 @@
+import codecs
+import json
+import os
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
+
+def iter_json_array(json_path, read_size=1 << 20):
+    """
+    流式遍历顶层为列表的json文件（如example/example_bg_data.json），内存中只保留当前读取块与当前元素
+    :param json_path: json文件路径
+    :param read_size: 每次从文件读取的字节数
+    :return: 生成器，逐个产出 (元素在文件中的字节偏移, 元素的字节长度, 元素)
+    """
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    idx = 0  # 当前解析位置（buf内的字符下标）
+    byte_pos = 0  # buf[idx]在文件中的字节偏移
+    started = eof = False
+    with open(json_path, 'rb') as f:
+        while True:
+            # 跳过空白
+            while idx < len(buf) and buf[idx] in ' \t\r\n':
+                byte_pos += 1
+                idx += 1
+            if idx < len(buf):
+                c = buf[idx]
+                if not started:
+                    if c == '\ufeff' and byte_pos == 0:  # 跳过BOM
+                        byte_pos += 3
+                        idx += 1
+                        continue
+                    if c != '[':
+                        raise ValueError(f"{json_path} 顶层应为列表")
+                    started = True
+                    byte_pos += 1
+                    idx += 1
+                    continue
+                if c == ',':
+                    byte_pos += 1
+                    idx += 1
+                    continue
+                if c == ']':
+                    return
+                try:
+                    obj, end = decoder.raw_decode(buf, idx)
+                except json.JSONDecodeError:
+                    # 当前元素可能被读取块截断，继续读取后重试
+                    if eof:
+                        raise
+                else:
+                    if end < len(buf) or eof:
+                        n_bytes = len(buf[idx:end].encode('utf-8'))
+                        yield byte_pos, n_bytes, obj
+                        byte_pos += n_bytes
+                        idx = end
+                        continue
+            elif eof:
+                if not started:
+                    raise ValueError(f"{json_path} 顶层应为列表")
+                return
+            # 读入更多数据，同时丢弃已解析的部分
+            chunk = f.read(read_size)
+            eof = not chunk
+            buf = buf[idx:] + utf8_decoder.decode(chunk, final=eof)
+            idx = 0
+
+
+def mask_to_rle(roi_mask, origin, image_size):
+    """
+    将位于图像局部区域的二值mask编码为COCO格式的未压缩RLE（按列优先展开整张图，从0的游程开始），
+    可直接由pycocotools.mask.frPyObjects读取。只遍历局部区域，开销与区域面积成正比
+    :param roi_mask: (h, w)布尔数组，局部区域内的mask
+    :param origin: 局部区域左上角在图像中的坐标(x, y)
+    :param image_size: 图像(width, height)
+    :return: dict，{"size": [height, width], "counts": [...]}
+    """
+    width, height = image_size
+    x0, y0 = origin
+    h, w = roi_mask.shape
+    # 每列上下各补一行0，按列优先展开后，游程的起止点即为相邻元素不同之处
+    padded = np.zeros((w, h + 2), dtype=np.int8)
+    padded[:, 1:-1] = roi_mask.T
+    change = np.flatnonzero(np.diff(padded.ravel()))
+    # 换算为整张图按列优先展开时的下标（变化点的下一个元素）
+    column, row = np.divmod(change + 1, h + 2)
+    positions = (x0 + column) * height + y0 + row - 1
+    starts, ends = positions[0::2], positions[1::2]
+    if len(starts) > 1:
+        # 局部区域与图像等高时，相邻两列首尾相接的游程需要合并
+        keep = np.ones(len(starts), dtype=np.bool_)
+        keep[1:] = starts[1:] != ends[:-1]
+        starts = starts[keep]
+        ends = ends[np.append(keep[1:], True)]
+    bounds = np.empty(len(starts) * 2 + 2, dtype=np.int64)
+    bounds[0] = 0
+    bounds[1:-1:2] = starts
+    bounds[2:-1:2] = ends
+    bounds[-1] = width * height
+    counts = np.diff(bounds).tolist()
+    if len(counts) > 1 and counts[-1] == 0:
+        # 以1的游程结束时，末尾没有0的游程
+        counts.pop()
+    return {'size': [int(height), int(width)], 'counts': counts}
+
+
+def rle_to_mask(rle):
+    """
+    mask_to_rle的逆过程
+    :return: (height, width)布尔数组
+    """
+    height, width = rle['size']
+    values = np.zeros(len(rle['counts']), dtype=np.bool_)
+    values[1::2] = True
+    return np.repeat(values, rle['counts']).reshape(width, height).T
+
+
+# bbox坐标的存储类型。float32足以精确表示像素坐标（整数及常见的小数），内存占用只有float64的一半
+BOX_DTYPE = np.float32
+# 二进制缓存格式的版本号，格式改变时递增，旧缓存会自动重建
+BG_CACHE_VERSION = 1
+
+
+def boxes_to_list(boxes):
+    """
+    将bbox数组转为列表。float32按其最短的十进制表示转为float，输出json时不会出现123.4000015258789这样的数字
+    """
+    if boxes.dtype == np.float32:
+        return boxes.astype(str).astype(np.float64).tolist()
+    return boxes.tolist()
+
+
+def get_box_sizes(boxes):
+    """
+    :param boxes: bbox列表或(N, 8)数组，每个bbox为[x1, y1, ..., x4, y4]
+    :return: (N, 2)数组，每行为bbox外接框的(width, height)
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 8)
+    xs, ys = boxes[:, 0::2], boxes[:, 1::2]
+    return np.stack([xs.max(axis=1) - xs.min(axis=1), ys.max(axis=1) - ys.min(axis=1)], axis=1)
+
+
+def get_size_stats(sizes):
+    """
+    :param sizes: (N, 2)数组，见get_box_sizes
+    :return: dict，内含count与sum（(width, height)数组），用于求平均宽高
+    """
+    return {'count': len(sizes), 'sum': sizes.sum(axis=0) if len(sizes) else np.zeros(2)}
+
+
+class BgAnnotation:
+    """
+    单张背景图的只读标注。每类bbox存为一个(N, 8)的只读float32数组，同一背景被多次抽中时共享同一份记录。
+    建立记录时同时计算每类bbox的宽高（box_sizes），其统计量（size_stats）与按类别组合排序后的宽高（get_sorted_sizes）
+    在第一次用到时计算一次，自动缩放时直接使用，不再每次重新遍历坐标
+    """
+    __slots__ = ('img_name', 'img_class', 'boxes', 'exist_category', 'extra', 'box_sizes', '_size_stats',
+                 '_sorted_sizes')
+
+    def __init__(self, one_dict, boxes=None):
+        """
+        :param one_dict: 原始标注dict，内含img_name、instances、exist_category等key
+        :param boxes: dict，category -> (N, 8)数组。给定时不再解析one_dict中的instances（如来自二进制缓存的内存映射）
+        """
+        self.img_name = one_dict['img_name']
+        self.img_class = one_dict.get('img_class')
+        if boxes is None:
+            boxes = {category: np.array(box_list, dtype=BOX_DTYPE).reshape(-1, 8)
+                     for category, box_list in one_dict.get('instances', {}).items()}
+        self.boxes = {}
+        self.box_sizes = {}
+        for category, category_boxes in boxes.items():
+            category_boxes.flags.writeable = False
+            self.boxes[category] = category_boxes
+            sizes = get_box_sizes(category_boxes)
+            sizes.flags.writeable = False
+            self.box_sizes[category] = sizes
+        self._size_stats = None
+        self._sorted_sizes = {}
+        self.exist_category = tuple(one_dict.get('exist_category', ()))
+        # 保留原dict的全部key及顺序，输出json时instances与exist_category替换为合成后的结果
+        self.extra = dict(one_dict)
+        self.extra['instances'] = self.extra['exist_category'] = None
+
+    @property
+    def size_stats(self):
+        """
+        :return: dict，category -> 该类bbox宽高的统计量，见get_size_stats
+        """
+        if self._size_stats is None:
+            self._size_stats = {category: get_size_stats(sizes) for category, sizes in self.box_sizes.items()}
+        return self._size_stats
+
+    def get_sorted_sizes(self, categories):
+        """
+        :param categories: 类别元组
+        :return: (2, N)只读数组，给定类别全部bbox的width与height各自从小到大排序；按类别组合缓存，只排序一次
+        """
+        sorted_sizes = self._sorted_sizes.get(categories)
+        if sorted_sizes is None:
+            parts = [self.box_sizes[category] for category in categories if category in self.box_sizes]
+            sizes = np.concatenate(parts) if parts else np.zeros((0, 2))
+            sorted_sizes = np.sort(sizes.T, axis=1)
+            sorted_sizes.flags.writeable = False
+            self._sorted_sizes[categories] = sorted_sizes
+        return sorted_sizes
+
+
+class CompositeAnnotation:
+    """
+    一张合成图的标注：只读的背景标注base，加上本次新粘贴bbox的覆盖层。
+    base不会被修改，因此每张合成图的开销与背景被重复使用的次数无关
+    """
+
+    def __init__(self, bg_img_info, base=None, track_instances=False):
+        """
+        :param bg_img_info: dict，内含img_name、bg_width、bg_height
+        :param base: 背景图已有的标注（BgAnnotation），没有则为None
+        :param track_instances: 是否逐个记录本次粘贴的instance（编号、类别、bbox），输出在json的pasted_instances中，
+                                编号与instance-ID图中的像素值一致
+        """
+        self.bg_img_info = bg_img_info
+        self.base = base
+        self.new_instances = {}  # 本次粘贴的bbox，category -> [bbox, ...]
+        self.new_sizes = {}  # 本次粘贴bbox的宽高，category -> [(width, height), ...]
+        self.new_category = []
+        self.pasted_instances = [] if track_instances else None
+        self.num_pasted = 0
+        self._instances = None
+        self._sorted_sizes = {}  # 类别元组 -> 背景原有与本次粘贴bbox排序后的宽高，见get_median_size
+
+    @property
+    def exist_category(self):
+        base_category = list(self.base.exist_category) if self.base is not None else []
+        return base_category + self.new_category
+
+    @property
+    def instances(self):
+        """
+        :return: dict，category -> (N, 8)数组，包含背景原有和本次新粘贴的全部bbox
+        """
+        if self._instances is None:
+            instances = dict(self.base.boxes) if self.base is not None else {}
+            for category, box_list in self.new_instances.items():
+                new_boxes = np.array(box_list, dtype=np.float64).reshape(-1, 8)
+                instances[category] = np.concatenate([instances[category], new_boxes]) \
+                    if category in instances else new_boxes
+            self._instances = instances
+        return self._instances
+
+    @property
+    def num_boxes(self):
+        """
+        :return: 背景原有与本次粘贴的bbox总数
+        """
+        base_num = sum(len(sizes) for sizes in self.base.box_sizes.values()) if self.base is not None else 0
+        return base_num + self.num_pasted
+
+    def get_box_sizes(self, categories):
+        """
+        :param categories: 类别列表，没有bbox的类别会被跳过
+        :return: (N, 2)数组，给定类别的全部bbox（背景原有与本次粘贴）的(width, height)
+        """
+        parts = []
+        for category in categories:
+            if self.base is not None and category in self.base.box_sizes:
+                parts.append(self.base.box_sizes[category])
+            if category in self.new_sizes:
+                parts.append(np.array(self.new_sizes[category], dtype=np.float64))
+        return np.concatenate(parts) if parts else np.zeros((0, 2))
+
+    def get_mean_size(self, categories):
+        """
+        由预先计算的每类宽高之和求平均值，开销与bbox数量无关
+        :return: (平均width, 平均height)；给定类别没有任何bbox时返回None
+        """
+        total = np.zeros(2)
+        count = 0
+        for category in categories:
+            if self.base is not None and category in self.base.size_stats:
+                total += self.base.size_stats[category]['sum']
+                count += self.base.size_stats[category]['count']
+            for size in self.new_sizes.get(category, ()):
+                total += size
+                count += 1
+        if not count:
+            return None
+        return total[0] / count, total[1] / count
+
+    def get_median_size(self, categories):
+        """
+        宽高的中位数（与np.median结果一致）。背景原有bbox排序后的宽高由base缓存，本次粘贴的bbox在add时插入到已排序的位置，
+        不需要每次重新拼接、排序全部bbox
+        :return: (width中位数, height中位数)；给定类别没有任何bbox时返回None
+        """
+        key = tuple(categories)
+        sorted_sizes = self._sorted_sizes.get(key)
+        if sorted_sizes is None:
+            sorted_sizes = self.base.get_sorted_sizes(key) if self.base is not None else np.zeros((2, 0))
+            new_sizes = [size for category in key for size in self.new_sizes.get(category, ())]
+            if new_sizes:
+                sorted_sizes = np.sort(np.concatenate([sorted_sizes, np.array(new_sizes).T], axis=1), axis=1)
+            self._sorted_sizes[key] = sorted_sizes
+        num = sorted_sizes.shape[1]
+        if not num:
+            return None
+        median = (sorted_sizes[:, (num - 1) // 2] + sorted_sizes[:, num // 2]) / 2
+        return median[0], median[1]
+
+    def add(self, category, bbox):
+        """
+        :return: 本次粘贴的instance编号，从1开始
+        """
+        if category not in self.new_instances:
+            self.new_instances[category] = []
+            if self.base is None or category not in self.base.boxes:
+                self.new_category.append(category)
+        self.new_instances[category].append(bbox)
+        size = (max(bbox[0::2]) - min(bbox[0::2]), max(bbox[1::2]) - min(bbox[1::2]))
+        self.new_sizes.setdefault(category, []).append(size)
+        for key, sorted_sizes in self._sorted_sizes.items():
+            if category in key:
+                self._sorted_sizes[key] = np.stack([np.insert(row, np.searchsorted(row, value), value)
+                                                    for row, value in zip(sorted_sizes, size)])
+        self._instances = None
+        self.num_pasted += 1
+        if self.pasted_instances is not None:
+            self.pasted_instances.append({'instance_id': self.num_pasted, 'category': category, 'bbox': bbox})
+        return self.num_pasted
+
+    def set_boxes(self, instances, image_size):
+        """
+        用变换后的bbox替换全部bbox（背景原有与本次粘贴），用于对整张合成图做几何增强之后。
+        背景原有的bbox另存为新的BgAnnotation，共享的base不受影响
+        :param instances: dict，category -> (N, 8)数组，每类的顺序与instances属性一致（背景原有在前，本次粘贴在后）
+        :param image_size: 变换后合成图的(width, height)
+        """
+        base_boxes = {}
+        new_instances = {}
+        for category, boxes in instances.items():
+            num_base = 0
+            if self.base is not None and category in self.base.boxes:
+                num_base = len(self.base.boxes[category])
+                base_boxes[category] = boxes[:num_base].astype(BOX_DTYPE)
+            if category in self.new_instances:
+                new_instances[category] = boxes[num_base:].tolist()
+        if self.base is not None:
+            base_dict = dict(self.base.extra)
+            base_dict['exist_category'] = self.base.exist_category
+            self.base = BgAnnotation(base_dict, base_boxes)
+        if self.pasted_instances is not None:
+            # 同一类别的instance在pasted_instances与new_instances中的先后顺序一致
+            counts = {}
+            for instance in self.pasted_instances:
+                category = instance['category']
+                instance['bbox'] = new_instances[category][counts.get(category, 0)]
+                counts[category] = counts.get(category, 0) + 1
+        self.new_instances = new_instances
+        self.new_sizes = {category: [tuple(size) for size in get_box_sizes(box_list).tolist()]
+                          for category, box_list in new_instances.items()}
+        self.bg_img_info = dict(self.bg_img_info, bg_width=image_size[0], bg_height=image_size[1])
+        self._instances = None
+        self._sorted_sizes = {}
+
+    def to_dict(self):
+        """
+        :return: 与example/example_bg_data.json同格式的dict，另加bg_img_info
+        """
+        instances = {}
+        if self.base is not None:
+            for category, boxes in self.base.boxes.items():
+                instances[category] = boxes_to_list(boxes)
+        for category, box_list in self.new_instances.items():
+            instances[category] = instances.get(category, []) + box_list
+        if self.base is None:
+            data_dict = {"bg_img_info": self.bg_img_info, 'instances': instances, 'exist_category': self.new_category}
+        else:
+            data_dict = dict(self.base.extra)
+            data_dict['instances'] = instances
+            data_dict['exist_category'] = self.exist_category
+            data_dict['bg_img_info'] = self.bg_img_info
+        if self.pasted_instances is not None:
+            data_dict['pasted_instances'] = self.pasted_instances
+        return data_dict
+
+
+class BgAnnotationIndex:
+    """
+    背景标注索引。加载时建立一次 img_name 到标注的映射，
+    之后每次检索为O(1)，不再需要遍历整个标注列表。加载时流式读取文件，逐条转为紧凑的float32数组，不会把整个json读入内存。
+    lazy=True时只流式扫描一遍文件，记录每条标注在文件中的字节位置，检索时再按需读取解析，适合无法整体json.load的大文件。
+    cache=True时第一次加载会在json旁生成二进制缓存：全部bbox连续存放在.bgcache.bin（float32），
+    其余字段与每类bbox在其中的位置存放在.bgcache.jsonl。之后的运行直接内存映射bbox，不再解析json；json有改动时自动重建。
+
+    backgrounds文件夹不分类别，只按img_name检索；同名图片以文件中第一次出现的为准（与原先线性查找一致），加载时给出警告
+    """
+
+    # lazy/cache模式下最近读取过的标注保留的条数。gen_num模式下背景会被反复抽中，
+    # 命中时直接复用已构建的BgAnnotation，不再重新读取、计算bbox尺寸与size_stats
+    LOADED_CACHE_SIZE = 256
+
+    def __init__(self, json_path, lazy=False, cache=False):
+        """
+        :param json_path: 背景标注json路径，格式见example/example_bg_data.json
+        :param lazy: 是否按需读取标注
+        :param cache: 是否使用二进制缓存（优先于lazy）
+        """
+        self.json_path = json_path
+        self.lazy = lazy
+        self.cache = cache
+        self._loaded = OrderedDict()  # 按背景标注条目的LRU，条目 -> BgAnnotation
+        self._by_name = {}
+        self._num_duplicates = 0
+        self._boxes = None  # 二进制缓存中全部bbox的内存映射
+        if cache:
+            if not self._open_cache():
+                self._build_cache()
+                if not self._open_cache():
+                    raise RuntimeError(f"{json_path} 的二进制缓存建立失败")
+        elif lazy:
+            for offset, n_bytes, one_dict in iter_json_array(json_path):
+                self._add(one_dict, (offset, n_bytes))
+        else:
+            for _, _, one_dict in iter_json_array(json_path):
+                self._add(one_dict, BgAnnotation(one_dict))
+        if self._num_duplicates:
+            warnings.warn(f"{json_path} 中有{self._num_duplicates}条标注的img_name与之前的标注重复，"
+                          f"这些图片使用文件中第一次出现的标注", UserWarning)
+
+    def _add(self, one_dict, entry):
+        # 同名图片以第一次出现的为准，与原先线性查找的结果保持一致
+        if one_dict['img_name'] in self._by_name:
+            self._num_duplicates += 1
+            return
+        self._by_name[one_dict['img_name']] = entry
+
+    def _cache_paths(self):
+        """
+        :return: (索引文件路径, bbox数据文件路径)
+        """
+        return self.json_path + '.bgcache.jsonl', self.json_path + '.bgcache.bin'
+
+    def _source_signature(self):
+        stat = os.stat(self.json_path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _build_cache(self):
+        """
+        流式读取json，将bbox依次写入数据文件，每张背景的其余字段与各类bbox的位置写入索引文件（每行一个json）
+        """
+        index_path, boxes_path = self._cache_paths()
+        tmp_suffix = f".{os.getpid()}.tmp"
+        num_boxes = 0
+        with open(boxes_path + tmp_suffix, 'wb') as boxes_file, open(index_path + tmp_suffix, 'w') as index_file:
+            index_file.write(json.dumps({'version': BG_CACHE_VERSION, 'source': self._source_signature()}) + "\n")
+            for _, _, one_dict in iter_json_array(self.json_path):
+                segments = []
+                for category, box_list in one_dict.get('instances', {}).items():
+                    boxes = np.array(box_list, dtype=BOX_DTYPE).reshape(-1, 8)
+                    boxes_file.write(boxes.tobytes())
+                    segments.append([category, num_boxes, len(boxes)])
+                    num_boxes += len(boxes)
+                extra = dict(one_dict)
+                extra['instances'] = None
+                index_file.write(json.dumps({'extra': extra, 'segments': segments}, ensure_ascii=False) + "\n")
+        # 先替换数据文件再替换索引文件，索引文件存在时数据文件一定完整
+        os.replace(boxes_path + tmp_suffix, boxes_path)
+        os.replace(index_path + tmp_suffix, index_path)
+
+    def _open_cache(self):
+        """
+        :return: 缓存是否存在且与json一致
+        """
+        index_path, boxes_path = self._cache_paths()
+        if not (os.path.exists(index_path) and os.path.exists(boxes_path)):
+            return False
+        with open(index_path, 'rb') as f:
+            header = json.loads(f.readline())
+            if header.get('version') != BG_CACHE_VERSION or header.get('source') != self._source_signature():
+                return False
+            offset = f.tell()
+            for line in f:
+                self._add(json.loads(line)['extra'], (offset, len(line)))
+                offset += len(line)
+        num_boxes = os.path.getsize(boxes_path) // (8 * np.dtype(BOX_DTYPE).itemsize)
+        self._boxes = np.memmap(boxes_path, dtype=BOX_DTYPE, mode='r', shape=(num_boxes, 8)) \
+            if num_boxes else np.zeros((0, 8), dtype=BOX_DTYPE)
+        return True
+
+    def _load(self, entry):
+        if not self.lazy and self._boxes is None:
+            return entry
+        annotation = self._loaded.get(entry)
+        if annotation is not None:
+            self._loaded.move_to_end(entry)
+            return annotation
+        annotation = self._read(entry)
+        self._loaded[entry] = annotation
+        if len(self._loaded) > self.LOADED_CACHE_SIZE:
+            self._loaded.popitem(last=False)
+        return annotation
+
+    def _read(self, entry):
+        """
+        :param entry: (标注在文件中的字节偏移, 字节长度)
+        """
+        if self._boxes is not None:
+            offset, n_bytes = entry
+            with open(self._cache_paths()[0], 'rb') as f:
+                f.seek(offset)
+                record = json.loads(f.read(n_bytes))
+            boxes = {category: self._boxes[start:start + count] for category, start, count in record['segments']}
+            return BgAnnotation(record['extra'], boxes)
+        offset, n_bytes = entry
+        with open(self.json_path, 'rb') as f:
+            f.seek(offset)
+            return BgAnnotation(json.loads(f.read(n_bytes).decode('utf-8')))
+
+    def get(self, img_name):
+        """
+        :param img_name: 背景图片文件名
+        :return: 该背景图对应的只读标注（BgAnnotation）；找不到返回None
+        """
+        entry = self._by_name.get(img_name)
+        return None if entry is None else self._load(entry)
+
+    def __contains__(self, img_name):
+        return img_name in self._by_name
+
+    def __len__(self):
+        return len(self._by_name)
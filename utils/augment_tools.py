@@ -0,0 +1,121 @@
+import numpy as np
+
+
+def get_light_lut(alpha):
+    """
+    :param alpha: 亮度系数
+    :return: 256项uint8查找表，取整方式与cv2.addWeighted一致
+    """
+    return np.clip(np.rint(np.arange(256) * alpha), 0, 255).astype(np.uint8)
+
+
+class InstanceAugment:
+    """
+    单个instance粘贴前的增强：水平翻转、调整亮度、旋转。
+    随机参数在第一阶段（只有尺寸、尚未解码图片时）抽取，旋转后的外接尺寸直接参与粘贴位置的采样；
+    第二阶段缩放之后再作用于instance数组与alpha，不产生任何中间文件
+    """
+
+    def __init__(self, ins_size, flip=False, light_alpha=None, angle=None):
+        """
+        :param ins_size: 缩放后instance的(width, height)
+        :param flip: 是否水平翻转
+        :param light_alpha: 亮度系数，为None时不调整
+        :param angle: 旋转角度（逆时针），为None时不旋转
+        """
+        import cv2
+
+        self.flip = flip
+        self.light_alpha = light_alpha
+        self.angle = angle
+        width, height = ins_size
+        self.matrix = None
+        self.size = ins_size
+        if angle is not None:
+            rangle = np.deg2rad(angle)
+            new_width = int(np.ceil(abs(np.cos(rangle)) * width + abs(np.sin(rangle)) * height))
+            new_height = int(np.ceil(abs(np.sin(rangle)) * width + abs(np.cos(rangle)) * height))
+            # 连续坐标（像素i覆盖[i, i+1)）下绕instance中心旋转，再平移到新画布中央
+            matrix = np.eye(3)
+            matrix[:2] = cv2.getRotationMatrix2D((width * 0.5, height * 0.5), angle, 1.)
+            matrix[:2, 2] += ((new_width - width) * 0.5, (new_height - height) * 0.5)
+            self.matrix = matrix
+            self.size = (new_width, new_height)
+        self._corners = np.array([[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float64)
+        if self.matrix is not None:
+            self._corners = self._corners @ self.matrix[:2, :2].T + self.matrix[:2, 2]
+
+    @classmethod
+    def sample(cls, ins_size, args, rng):
+        """
+        按args中各项概率抽取一个instance的增强参数。各概率均为0时不从rng中抽取任何随机数
+        :param ins_size: 缩放后instance的(width, height)
+        :param rng: 本张合成图的随机数流
+        :return: InstanceAugment；没有任何增强生效时返回None
+        """
+        flip = args.instance_flip_rate > 0 and rng.random() < args.instance_flip_rate
+        light_alpha = None
+        if args.instance_light_rate > 0 and rng.random() < args.instance_light_rate:
+            light_alpha = rng.uniform(0.35, 1)
+        angle = None
+        if args.instance_rotation_rate > 0 and rng.random() < args.instance_rotation_rate:
+            angle = rng.uniform(-args.instance_max_rotation_angle, args.instance_max_rotation_angle)
+        if not flip and light_alpha is None and angle is None:
+            return None
+        return cls(ins_size, flip, light_alpha, angle)
+
+    def get_bbox(self, coord):
+        """
+        :param coord: 增强后instance画布的粘贴位置(x, y)
+        :return: instance的bounding box，[x1, y1, x2, y2, x3, y3, x4, y4]；旋转时为旋转后的四边形
+        """
+        if self.matrix is None:
+            x, y = coord
+            width, height = self.size
+            return [x, y, x + width, y, x + width, y + height, x, y + height]
+        return (self._corners + coord).ravel().tolist()
+
+    def apply(self, ins_array, alpha):
+        """
+        :param ins_array: 缩放后的instance数组，(h, w)或(h, w, C)
+        :param alpha: 缩放后的(h, w) alpha数组，可为None
+        :return: (增强后的instance数组, 增强后的alpha数组)；旋转时即使原来没有alpha也会生成alpha，旋转后多出的角落为透明
+        """
+        import cv2
+
+        if self.flip:
+            ins_array = np.ascontiguousarray(ins_array[:, ::-1])
+            alpha = np.ascontiguousarray(alpha[:, ::-1]) if alpha is not None else None
+        if self.light_alpha is not None:
+            ins_array = cv2.LUT(ins_array, get_light_lut(self.light_alpha))
+        if self.matrix is not None:
+            if alpha is None:
+                alpha = np.full(ins_array.shape[:2], 255, dtype=np.uint8)
+            # warpAffine以像素中心为整数坐标，与连续坐标相差半个像素
+            pixel_matrix = self.matrix.copy()
+            pixel_matrix[:2, 2] += pixel_matrix[:2, :2].sum(axis=1) * 0.5 - 0.5
+            ins_array = cv2.warpAffine(ins_array, pixel_matrix[:2], self.size, flags=cv2.INTER_LINEAR)
+            alpha = cv2.warpAffine(alpha, pixel_matrix[:2], self.size, flags=cv2.INTER_LINEAR)
+        return ins_array, alpha
+
+
+def augment_composite(augmenter, canvas, annotation, label_maps, rng):
+    """
+    对拼好的整张合成图做增强（augmentation.DataAugmentForObjectDetection），不经过任何中间文件。
+    几何变换同时作用于全部bbox（背景原有与本次粘贴）以及mask、instance-ID图与类别ID图
+    :param augmenter: DataAugmentForObjectDetection，需keep_quad=True，以保留标注的四边形格式
+    :param canvas: 合成图数组
+    :param annotation: 合成图的标注（annotation_tools.CompositeAnnotation），原地更新
+    :param label_maps: 需要与合成图同步做几何变换的(H, W)数组列表，None会被跳过
+    :param rng: 本张合成图的随机数流
+    :return: (增强后的合成图数组, 与label_maps一一对应的增强后数组列表，None保持为None)
+    """
+    categories = list(annotation.instances)
+    boxes = [annotation.instances[category] for category in categories]
+    all_boxes = np.concatenate(boxes) if boxes else np.zeros((0, 8))
+    maps = [label_map for label_map in label_maps if label_map is not None]
+    canvas, all_boxes, maps = augmenter.augment_with_maps(canvas, all_boxes, maps, rng)
+    splits = np.cumsum([len(category_boxes) for category_boxes in boxes])[:-1]
+    annotation.set_boxes(dict(zip(categories, np.split(all_boxes, splits))), (canvas.shape[1], canvas.shape[0]))
+    maps = iter(maps)
+    return canvas, [next(maps) if label_map is not None else None for label_map in label_maps]
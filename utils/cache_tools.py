@@ -0,0 +1,191 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from utils.image_tools import load_image_array, make_instance_buffer
+
+
+def get_image_nbytes(img):
+    """
+    估算PIL图像解码后占用的内存（字节）
+    """
+    if img is None:
+        return 0
+    return img.width * img.height * len(img.getbands())
+
+
+class InstanceCache:
+    """
+    已解码instance图片与mask的LRU缓存。同一批instance会在整个运行过程中被反复粘贴，
+    缓存后不必每次都重新Image.open解码。占用内存超过上限时淘汰最久未使用的instance。
+
+    pyramid_levels > 0时，每个instance额外保存若干级逐级缩小一半的版本，缩放时可以从最接近目标尺寸的一级开始缩放，
+    开销更小（结果与直接从原图缩放略有差异）。
+
+    backend为cv2时，instance与mask在读取时就合并为一个多通道数组（见image_tools.make_instance_buffer），供OpenCV一次缩放
+    """
+
+    def __init__(self, max_bytes, pyramid_levels=0, resample=Image.Resampling.LANCZOS, backend='pil'):
+        """
+        :param max_bytes: 缓存占用内存上限（字节）。为0时不缓存
+        :param pyramid_levels: 每个instance预先缩小的级数
+        :param resample: 生成金字塔时的插值方法（backend为cv2时固定使用INTER_AREA）
+        :param backend: 缩放后端，'pil'或'cv2'，决定缓存内容的形式
+        """
+        self.max_bytes = max_bytes
+        self.pyramid_levels = pyramid_levels
+        self.resample = resample
+        self.backend = backend
+        self._entries = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _load(self, ins_path, mask_path):
+        ins_img = Image.open(ins_path)
+        ins_img.load()
+        mask_img = Image.open(mask_path).convert("L") if mask_path else None
+        if self.backend == 'cv2':
+            return self._load_buffers(ins_img, mask_img)
+        pyramid = []
+        level_img, level_mask = ins_img, mask_img
+        for _ in range(self.pyramid_levels):
+            level_size = (level_img.width // 2, level_img.height // 2)
+            if min(level_size) < 1:
+                break
+            level_img = level_img.resize(level_size, resample=self.resample)
+            level_mask = level_mask.resize(level_size, resample=self.resample) if level_mask else None
+            pyramid.append((level_img, level_mask))
+        nbytes = get_image_nbytes(ins_img) + get_image_nbytes(mask_img) + sum(
+            get_image_nbytes(img) + get_image_nbytes(mask) for img, mask in pyramid)
+        return ins_img, mask_img, pyramid, nbytes
+
+    def _load_buffers(self, ins_img, mask_img):
+        import cv2
+
+        buffer, color_mode = make_instance_buffer(ins_img, mask_img)
+        levels = [buffer]
+        for _ in range(self.pyramid_levels):
+            level_size = (levels[-1].shape[1] // 2, levels[-1].shape[0] // 2)
+            if min(level_size) < 1:
+                break
+            levels.append(cv2.resize(levels[-1], level_size, interpolation=cv2.INTER_AREA))
+        return levels, color_mode, mask_img is not None, sum(level.nbytes for level in levels)
+
+    def get(self, ins_path, mask_path=None):
+        """
+        :param ins_path: instance图片路径
+        :param mask_path: mask路径，为None时不读取mask
+        :return: backend为pil时：(instance图片, 灰度mask或None, 金字塔列表[(图片, mask), ...]，由大到小)；
+                 backend为cv2时：(各级数组列表，由大到小，第0级为原图, instance颜色模式, 是否含mask通道)
+        """
+        key = (ins_path, mask_path)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[:3]
+
+        self.misses += 1
+        entry = self._load(ins_path, mask_path)
+        nbytes = entry[3]
+        if nbytes <= self.max_bytes:
+            while self.cached_bytes + nbytes > self.max_bytes:
+                _, (_, _, _, evicted_nbytes) = self._entries.popitem(last=False)
+                self.cached_bytes -= evicted_nbytes
+                self.evictions += 1
+            self._entries[key] = entry
+            self.cached_bytes += nbytes
+        return entry[:3]
+
+    def stats(self):
+        """
+        :return: dict，内含命中/未命中/淘汰次数，以及当前缓存的instance数量与占用内存
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'cached_items': len(self._entries),
+            'cached_bytes': self.cached_bytes,
+        }
+
+
+class BackgroundCache:
+    """
+    解码后背景图的缓存。gen_num模式下同一张背景会被反复抽中，缓存后不必每次重新解码大尺寸PNG。
+    解码结果以.npy文件保存在cache_dir中（默认位于/dev/shm共享内存），各进程通过内存映射只读访问，
+    同一张背景在物理内存中只有一份，不会在每个worker里各复制一份。
+    所有进程写入的缓存总量受max_bytes限制，超出后新的背景不再缓存，照常从磁盘解码
+    """
+
+    def __init__(self, cache_dir, max_bytes, shared_bytes):
+        """
+        :param cache_dir: 缓存文件夹，由主进程创建与清理
+        :param max_bytes: 缓存总量上限（字节）
+        :param shared_bytes: 进程间共享的已缓存字节数（multiprocessing.Value，自带锁）
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.shared_bytes = shared_bytes
+        self._arrays = {}  # 本进程已打开的内存映射
+        self._uncached = set()  # 超出上限而无法缓存的背景，不再重复尝试
+        self.hits = 0
+        self.misses = 0
+
+    def _cache_path(self, bg_path):
+        return os.path.join(self.cache_dir, hashlib.md5(bg_path.encode('utf-8')).hexdigest() + '.npy')
+
+    def _try_store(self, bg_path, array):
+        """
+        将解码后的背景数组写入缓存文件
+        :return: 缓存文件的只读内存映射，无法缓存时返回None
+        """
+        with self.shared_bytes.get_lock():
+            if self.shared_bytes.value + array.nbytes > self.max_bytes:
+                return None
+            self.shared_bytes.value += array.nbytes
+        cache_path = self._cache_path(bg_path)
+        # 先写临时文件再重命名，其他进程不会读到写了一半的缓存
+        tmp_path = f"{cache_path[:-len('.npy')]}.{os.getpid()}.tmp.npy"
+        try:
+            np.save(tmp_path, array)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # 共享内存空间不足等情况下放弃缓存
+            with self.shared_bytes.get_lock():
+                self.shared_bytes.value -= array.nbytes
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return None
+        return np.load(cache_path, mmap_mode='r')
+
+    def get_array(self, bg_path):
+        """
+        :param bg_path: 背景图路径
+        :return: 背景图的可写uint8数组（见image_tools.load_image_array），来自缓存时为缓存数据的副本，可以直接在上面粘贴
+        """
+        array = self._arrays.get(bg_path)
+        if array is None and bg_path not in self._uncached:
+            cache_path = self._cache_path(bg_path)
+            if os.path.exists(cache_path):
+                # 其他进程已经缓存过
+                array = np.load(cache_path, mmap_mode='r')
+                self._arrays[bg_path] = array
+        if array is not None:
+            self.hits += 1
+            return np.array(array)
+
+        self.misses += 1
+        bg_array = load_image_array(bg_path)
+        if bg_path not in self._uncached:
+            array = self._try_store(bg_path, bg_array)
+            if array is None:
+                self._uncached.add(bg_path)
+            else:
+                self._arrays[bg_path] = array
+        return bg_array
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+from utils.normal_tools import build_ins_mask_map
+
+CATALOG_FILE_NAME = 'instance_catalog.json'
+CATALOG_VERSION = 2
+
+
+def list_instance_paths(ins_folder, controlnet_gen_data=False):
+    """
+    列出一个类别images文件夹下的全部instance图片
+    :param ins_folder: instances/{类别}/images文件夹
+    :param controlnet_gen_data: 是否为controlnet数据的文件夹格式
+    :return: (instance图片路径列表, 内容变化会影响结果的文件夹列表)
+    """
+    ins_path_list = []
+    watched_dirs = [ins_folder]
+    if controlnet_gen_data:
+        # 如果是controlnet合成数据，instances/{装备类型}/images 文件夹下，每张图片都有一个单独的文件夹.
+        # 同时还会有canny.jpg这样的不需要的数据，需要予以剔除
+        for ctrl_image_folder in os.listdir(ins_folder):
+            if "pipe_config" in ctrl_image_folder:  # 排除pipe_config文件夹
+                continue
+            watched_dirs.append(os.path.join(ins_folder, ctrl_image_folder))
+            for file in os.listdir(os.path.join(ins_folder, ctrl_image_folder)):
+                if "canny" in file:  # 排除canny.jpg等文件
+                    continue
+                ins_path_list.append(os.path.join(ins_folder, ctrl_image_folder, file))
+    else:
+        for file in os.listdir(ins_folder):
+            ins_path_list.append(os.path.join(ins_folder, file))
+    return ins_path_list, watched_dirs
+
+
+def get_file_signature(path):
+    """
+    :return: [文件大小, 修改时间(ns)]，用于判断文件是否变化
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def get_dir_mtime(path):
+    return os.stat(path).st_mtime_ns if os.path.isdir(path) else None
+
+
+def get_file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def describe_instance(ins_path, mask_path):
+    """
+    读取一个instance的元数据。图片只读取文件头获取尺寸，mask需要解码以计算紧致外接框
+    :return: dict，内含width、height、mask_bbox（instance像素坐标下的[x_min, y_min, x_max, y_max]，
+             mask为空或没有mask时为None）、hash
+    """
+    with Image.open(ins_path) as ins_img:
+        width, height = ins_img.size
+    mask_bbox = None
+    if mask_path:
+        with Image.open(mask_path) as mask_img:
+            mask = np.asarray(mask_img.convert("L"))
+        ys, xs = np.nonzero(mask)
+        if len(xs):
+            # controlnet数据的mask可能与instance尺寸不同，粘贴时mask会缩放到instance尺寸，
+            # 外接框同样换算到instance坐标下（向外取整），两种文件夹格式下含义一致
+            mask_height, mask_width = mask.shape
+            mask_bbox = [int(xs.min()) * width // mask_width, int(ys.min()) * height // mask_height,
+                         -(-(int(xs.max()) + 1) * width // mask_width), -(-(int(ys.max()) + 1) * height // mask_height)]
+    return {'width': width, 'height': height, 'mask_bbox': mask_bbox, 'hash': get_file_hash(ins_path)}
+
+
+class InstanceCatalog:
+    """
+    持久化的instance目录，保存在project_folder/instance_catalog.json。
+    每个instance记录图片路径、类别、mask路径、像素尺寸、mask紧致外接框与内容哈希，启动时直接读取，
+    在解码任何像素之前就可以决定缩放比例与粘贴位置（目前只用到尺寸；mask_bbox与hash仅作记录，供之后使用）。
+
+    每个类别记录其images、masks（以及controlnet数据的各个子文件夹）的修改时间，文件夹有变化（新增或删除文件）的类别会重新扫描。
+    每次加载时还会逐个检查已记录的图片与mask的大小与修改时间，原地覆盖（文件名不变、文件夹修改时间不变）的文件也会被发现。
+    大小与修改时间都没有变化的文件沿用原记录，只有新增或改动的instance需要重新读取
+    """
+
+    def __init__(self, project_folder, records):
+        """
+        :param project_folder: 项目文件夹
+        :param records: dict，instance路径 -> 记录
+        """
+        self.project_folder = project_folder
+        self.records = records
+
+    @property
+    def ins_path_list(self):
+        return sorted(self.records)
+
+    def get_mask_map(self):
+        return {ins_path: record['mask_path'] for ins_path, record in self.records.items()}
+
+    @classmethod
+    def load_or_build(cls, project_folder, ins_folder_list, controlnet_gen_data=False, refresh=False):
+        """
+        :param project_folder: 项目文件夹，目录文件保存在其中
+        :param ins_folder_list: 需要的各类别images文件夹
+        :param controlnet_gen_data: 是否为controlnet数据的文件夹格式
+        :param refresh: 为True时忽略已有目录文件，全部重新扫描
+        """
+        catalog_path = os.path.join(project_folder, CATALOG_FILE_NAME)
+        saved_classes = {}
+        if not refresh and os.path.exists(catalog_path):
+            with open(catalog_path, 'r') as f:
+                saved = json.load(f)
+            if saved.get('version') == CATALOG_VERSION and saved.get('controlnet_gen_data') == controlnet_gen_data:
+                saved_classes = saved['classes']
+
+        changed = False
+        records = {}
+        for ins_folder in ins_folder_list:
+            class_name = os.path.basename(os.path.dirname(ins_folder))
+            class_entry = saved_classes.get(class_name)
+            if class_entry is None or any(get_dir_mtime(os.path.join(project_folder, rel_dir)) != mtime
+                                          for rel_dir, mtime in class_entry['dirs'].items()):
+                class_entry = cls._scan_class(project_folder, ins_folder, class_name, controlnet_gen_data,
+                                              class_entry['instances'] if class_entry else {})
+                saved_classes[class_name] = class_entry
+                changed = True
+            elif cls._refresh_changed(project_folder, class_entry):
+                changed = True
+            # 目录文件中的路径均相对于project_folder保存，项目文件夹移动后仍然有效
+            for rel_path, record in class_entry['instances'].items():
+                record = dict(record)
+                record['mask_path'] = os.path.join(project_folder, record['mask_path']) if record['mask_path'] else None
+                records[os.path.join(project_folder, rel_path)] = record
+
+        if changed:
+            tmp_path = f"{catalog_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': CATALOG_VERSION, 'controlnet_gen_data': controlnet_gen_data,
+                           'classes': saved_classes}, f, ensure_ascii=False)
+            os.replace(tmp_path, catalog_path)
+        return cls(project_folder, records)
+
+    @staticmethod
+    def _refresh_changed(project_folder, class_entry):
+        """
+        逐个检查一个类别已记录的图片与mask，大小或修改时间变化的instance重新读取，原地更新class_entry
+        :return: 是否有记录被更新
+        """
+        changed = False
+        for rel_path, record in class_entry['instances'].items():
+            ins_path = os.path.join(project_folder, rel_path)
+            mask_path = os.path.join(project_folder, record['mask_path']) if record['mask_path'] else None
+            signature = get_file_signature(ins_path)
+            mask_signature = get_file_signature(mask_path) if mask_path else None
+            if record['signature'] == signature and record['mask_signature'] == mask_signature:
+                continue
+            new_record = describe_instance(ins_path, mask_path)
+            new_record.update({
+                'class': record['class'],
+                'mask_path': record['mask_path'],
+                'signature': signature,
+                'mask_signature': mask_signature,
+            })
+            class_entry['instances'][rel_path] = new_record
+            changed = True
+        return changed
+
+    @staticmethod
+    def _scan_class(project_folder, ins_folder, class_name, controlnet_gen_data, old_instances):
+        """
+        重新扫描一个类别，大小与修改时间都没有变化的图片与mask沿用原记录
+        :return: dict，内含dirs（相对路径 -> 修改时间）与instances（相对路径 -> 记录）
+        """
+        rel = lambda path: os.path.relpath(path, project_folder)
+        ins_path_list, watched_dirs = list_instance_paths(ins_folder, controlnet_gen_data)
+        watched_dirs.append(os.path.join(os.path.dirname(ins_folder), 'masks'))
+        ins_mask_map, _ = build_ins_mask_map(ins_path_list, controlnet_gen_data)
+
+        instances = {}
+        for ins_path in ins_path_list:
+            mask_path = ins_mask_map[ins_path]
+            signature = get_file_signature(ins_path)
+            mask_signature = get_file_signature(mask_path) if mask_path else None
+            record = old_instances.get(rel(ins_path))
+            if (record is None or record['signature'] != signature or record['mask_signature'] != mask_signature
+                    or record['mask_path'] != (rel(mask_path) if mask_path else None)):
+                record = describe_instance(ins_path, mask_path)
+                record.update({
+                    'class': class_name,
+                    'mask_path': rel(mask_path) if mask_path else None,
+                    'signature': signature,
+                    'mask_signature': mask_signature,
+                })
+            instances[rel(ins_path)] = record
+        return {'dirs': {rel(d): get_dir_mtime(d) for d in watched_dirs}, 'instances': instances}
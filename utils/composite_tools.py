@@ -0,0 +1,241 @@
+import multiprocessing.util
+import os
+import random
+import warnings
+from collections import Counter
+
+import numpy as np
+from PIL import Image
+
+from utils.annotation_tools import CompositeAnnotation, mask_to_rle
+from utils.augment_tools import InstanceAugment, augment_composite
+from utils.cache_tools import BackgroundCache, InstanceCache
+from utils.image_tools import (get_array_mode, get_paste_bbox, get_scaled_size, get_some_instances, load_image_array,
+                               paste_array, resize_instances)
+from utils.output_tools import AsyncWriter, TarShardWriter, save_composite_outputs, save_composite_to_shard
+from utils.placement_tools import FreeSpaceSampler, RejectionSampler
+
+
+# 每个进程内共享的只读生成上下文，由init_worker设置
+_WORKER_CTX = {}
+
+
+def init_worker(ctx):
+    _WORKER_CTX.update(ctx)
+    _WORKER_CTX['shard_writer'] = TarShardWriter(
+        ctx['shard_folder'], ctx['args'].tar_shard_mb * 1024 * 1024) if ctx['shard_folder'] else None
+    # worker进程正常退出时写完剩余输出并关闭分片
+    multiprocessing.util.Finalize(None, close_worker, exitpriority=10)
+    args = ctx['args']
+    # 缓存属于各个进程自己，不在进程间共享
+    _WORKER_CTX['instance_cache'] = InstanceCache(
+        args.instance_cache_mb * 1024 * 1024, args.instance_pyramid_levels,
+        getattr(Image.Resampling, args.resample_method), args.resize_backend)
+    if args.resize_backend == 'cv2' and args.workers > 0:
+        import cv2
+
+        # 已经按进程并行，每个进程内的OpenCV只用一个线程，避免线程数超过CPU核数
+        cv2.setNumThreads(1)
+    _WORKER_CTX['writer'] = AsyncWriter(args.writer_threads, args.max_pending_writes)
+    _WORKER_CTX['composite_augmenter'] = None
+    if args.composite_aug:
+        from augmentation import DataAugmentForObjectDetection
+
+        # 合成图的标注为四边形，旋转后保留四边形；cutout会抹去instance而mask与ID图无法同步，不使用
+        _WORKER_CTX['composite_augmenter'] = DataAugmentForObjectDetection(
+            max_rotation_angle=args.composite_max_rotation_angle, is_cutout=False, keep_quad=True)
+    _WORKER_CTX['bg_cache'] = BackgroundCache(
+        ctx['bg_cache_dir'], args.bg_cache_mb * 1024 * 1024, ctx['bg_cache_bytes']) if ctx['bg_cache_dir'] else None
+
+
+def close_worker():
+    if 'writer' in _WORKER_CTX:
+        _WORKER_CTX['writer'].close()
+    if _WORKER_CTX.get('shard_writer') is not None:
+        _WORKER_CTX['shard_writer'].close()
+
+
+def get_composite_rng(seed, number):
+    """
+    由(seed, 合成图全局编号)派生一张合成图独立的随机数流。合成图的全部随机选择（背景、instance、缩放比例、粘贴位置）
+    都只从这个流中抽取，结果与workers数量、chunk_size以及其他合成图无关，单独重新生成某一张合成图也能得到完全相同的结果
+    :param seed: 随机种子
+    :param number: 合成图全局编号（index + index_offset）
+    :return: random.Random
+    """
+    return random.Random(f"{seed}-{number}")
+
+
+def get_class_id(category, yolo_class_list):
+    """
+    :return: 类别ID图中的像素值，为类别在yolo_class_list中的下标加1（0为背景）
+    """
+    if category not in yolo_class_list:
+        raise AttributeError(f"需要在args.yolo_class_list中按照yolo目标index顺序添加{category}类")
+    return yolo_class_list.index(category) + 1
+
+
+def add_instance_rles(annotation, id_map):
+    """
+    按最终的instance-ID图为每个粘贴的instance编码RLE（被后粘贴的instance遮挡的部分不计入），只读取各自bbox外接框内的区域
+    """
+    height, width = id_map.shape
+    for instance in annotation.pasted_instances:
+        bbox = instance['bbox']
+        # bbox经过旋转后为四边形，取外接框
+        x0, y0 = max(int(min(bbox[0::2])), 0), max(int(min(bbox[1::2])), 0)
+        x1, y1 = min(int(np.ceil(max(bbox[0::2]))), width), min(int(np.ceil(max(bbox[1::2]))), height)
+        roi_mask = id_map[y0:max(y0, y1), x0:max(x0, x1)] == instance['instance_id']
+        instance['rle'] = mask_to_rle(roi_mask, (x0, y0), (width, height))
+
+
+def make_composite(index, bg_path, ctx, rng):
+    """
+    在一张背景图上粘贴若干instance，并保存合成图、mask、json与yolo标签
+    :param index: 合成图编号（从0开始），决定输出文件名
+    :param bg_path: 背景图路径
+    :param ctx: 生成上下文，见run_paste.py主程序
+    :param rng: 本张合成图的随机数流，见get_composite_rng
+    :return: 是否至少粘贴了一个instance并保存
+    """
+    args = ctx['args']
+    # 合成直接在背景数组上原地进行，每次粘贴只访问instance所在区域
+    canvas = ctx['bg_cache'].get_array(bg_path) if ctx['bg_cache'] is not None else load_image_array(bg_path)
+    canvas_mode = get_array_mode(canvas)
+    bg_size = (canvas.shape[1], canvas.shape[0])
+    ins_num_per_bg = rng.randint(args.min_num_ins_per_bg, args.max_num_ins_per_bg)
+    selected_ins_path_list = get_some_instances(ctx['ins_path_list'], ins_num_per_bg, rng)
+    # mask在合成时为单通道，保存时再按mask_mode转换
+    mask_canvas = np.zeros(canvas.shape[:2], dtype=np.uint8)
+    # instance-ID图（0为背景，1起为本次粘贴的instance编号）与类别ID图，在粘贴时同步写入
+    track_instances = args.id_masks or args.rle_masks
+    id_map = np.zeros(canvas.shape[:2], dtype=np.uint16) if track_instances else None
+    class_map = np.zeros(canvas.shape[:2], dtype=np.uint8) if args.id_masks else None
+
+    bg_img_info = {
+        'img_name': os.path.basename(bg_path),
+        'bg_width': bg_size[0],
+        'bg_height': bg_size[1]
+    }
+    # 如果存在bg json数据，则按背景图片文件名读取
+    bg_base = None
+    if ctx['bg_annotations'] is not None:
+        bg_base = ctx['bg_annotations'].get(bg_img_info['img_name'])
+    # 背景原有标注只读共享，本次粘贴的bbox只记录在合成图自己的覆盖层中
+    annotation = CompositeAnnotation(bg_img_info, bg_base, track_instances)
+    if args.placement_method == 'grid':
+        placement_sampler = FreeSpaceSampler(bg_size, annotation.instances, rng)
+    else:
+        placement_sampler = RejectionSampler(bg_size, annotation.instances, args.max_attempt_finding_xy,
+                                             args.overlap_tolerance, args.overlap_metric, rng)
+
+    # 第一阶段：只根据目录中记录的尺寸决定每个instance的缩放尺寸与粘贴位置，找不到位置的instance不必解码
+    placements = []  # [(instance路径, 类别, 缩放后尺寸, 粘贴位置, instance编号, InstanceAugment或None), ...]
+    for ins_path in selected_ins_path_list:
+        record = ctx['ins_records'][ins_path]
+        new_size = get_scaled_size((record['width'], record['height']), bg_size, args, annotation, rng)
+        # instance增强（翻转、亮度、旋转）的参数在此抽取，旋转后的外接尺寸参与粘贴位置的采样
+        ins_augment = InstanceAugment.sample(new_size, args, rng)
+        x, y = placement_sampler.sample(ins_augment.size if ins_augment is not None else new_size)
+        if ctx['motion_path_coor'] is not None:
+            x = int(ctx['motion_path_coor'][index][0])
+            y = int(ctx['motion_path_coor'][index][1])
+        # 准备粘贴
+        if x is None or y is None:
+            continue
+        bbox = ins_augment.get_bbox((x, y)) if ins_augment is not None else get_paste_bbox((x, y), new_size)
+        instance_id = annotation.add(record['class'], bbox)
+        placement_sampler.occupy([bbox])
+        placements.append((ins_path, record['class'], new_size, (x, y), instance_id, ins_augment))
+
+    # 防止极端情况下一个合适的坐标都没找到，而生成无目标图
+    if not placements:
+        warnings.warn(f"背景图 {os.path.basename(bg_path)} 中难以粘贴合适的instance，请留意（该图像未保存）",
+                      UserWarning)
+        return False
+
+    # 第二阶段：一次性缩放全部instance，再依次粘贴
+    sources = [ctx['instance_cache'].get(ins_path, ctx['ins_mask_map'].get(ins_path))
+               for ins_path, _, _, _, _, _ in placements]
+    scaled = resize_instances(sources, [new_size for _, _, new_size, _, _, _ in placements], args.resample_method,
+                              canvas_mode, args.resize_backend)
+    for (_, category, _, coord, instance_id, ins_augment), (ins_array, alpha) in zip(placements, scaled):
+        if ins_augment is not None:
+            ins_array, alpha = ins_augment.apply(ins_array, alpha)
+        labels = []
+        if id_map is not None:
+            labels.append((id_map, instance_id))
+        if class_map is not None:
+            labels.append((class_map, get_class_id(category, args.yolo_class_list)))
+        # 按mask将instance混合进背景，同时把mask、instance ID与类别ID写入各自的图中
+        paste_array(canvas, ins_array, coord, alpha, mask_canvas, labels)
+
+    # 对整张合成图做增强，全部bbox、mask与ID图同步做几何变换
+    if ctx['composite_augmenter'] is not None:
+        canvas, (mask_canvas, id_map, class_map) = augment_composite(
+            ctx['composite_augmenter'], canvas, annotation, [mask_canvas, id_map, class_map], rng)
+
+    # 输出编号由index决定，各进程的编号范围互不重叠。编码与写盘交给后台线程，生成循环不等待磁盘
+    name_allocator = ctx['name_allocator']
+    encoding = ctx['encoding']
+    ctx['run_metadata'].save_once()
+    if args.rle_masks:
+        add_instance_rles(annotation, id_map)
+    bg_img = Image.fromarray(canvas, canvas_mode)
+    out_mask_img = Image.fromarray(mask_canvas, 'L') if not args.no_ins_mask else None
+    # (后缀, 图像)，instance-ID图保存为16位灰度png
+    label_maps = [('ids', Image.fromarray(id_map)), ('cls', Image.fromarray(class_map, 'L'))] if args.id_masks else []
+    if ctx['shard_writer'] is not None:
+        _, key = name_allocator.get_name(index)
+        ticket = ctx['shard_writer'].reserve()
+        try:
+            ctx['writer'].submit(save_composite_to_shard, ctx['shard_writer'], ticket, index, key, encoding,
+                                 bg_img, out_mask_img, annotation.to_dict(), args.yolo_class_list,
+                                 [(f".{name}.png", label_img) for name, label_img in label_maps])
+        except BaseException:
+            ctx['shard_writer'].skip(ticket)
+            raise
+    else:
+        label_folder = ctx['composite_label_folder']
+        ctx['writer'].submit(
+            save_composite_outputs, encoding,
+            bg_img, name_allocator.get_path(ctx['composite_save_folder'], index, encoding.image_suffix),
+            out_mask_img,
+            name_allocator.get_path(ctx['comp_mask_save_folder'], index, "_mask.png") if not args.no_ins_mask else None,
+            annotation.to_dict(),
+            name_allocator.get_path(os.path.join(label_folder, 'json'), index, ".json"),
+            name_allocator.get_path(os.path.join(label_folder, 'yolo_txt'), index, ".txt"),
+            args.yolo_class_list,
+            [(label_img, name_allocator.get_path(ctx['comp_mask_save_folder'], index, f"_{name}.png"))
+             for name, label_img in label_maps]
+        )
+    return True
+
+
+def run_chunk(indices):
+    """
+    生成一个任务块内的所有合成图
+    :param indices: 该块内的合成图编号列表
+    :return: Counter，内含本块合成图数量、成功保存数量，以及本块内各缓存的命中/未命中次数
+    """
+    ctx = _WORKER_CTX
+    args = ctx['args']
+    caches = {'instance_cache': ctx['instance_cache'], 'bg_cache': ctx['bg_cache']}
+    caches = {name: cache for name, cache in caches.items() if cache is not None}
+    counters_before = {name: (cache.hits, cache.misses) for name, cache in caches.items()}
+    stats = Counter(done=len(indices))
+    for index in indices:
+        # 每张合成图使用自己的随机数流，不依赖也不影响进程内的全局随机状态
+        rng = get_composite_rng(ctx['seed'], index + args.index_offset)
+        if args.gen_num > 0:
+            bg_path = rng.choice(ctx['bg_path_list'])
+        else:
+            bg_path = ctx['bg_path_list'][index]
+        stats['saved'] += make_composite(index, bg_path, ctx, rng)
+    # 任务块结束前写完本块的全部输出，主进程统计到的都是已经落盘的结果
+    ctx['writer'].flush()
+    for name, cache in caches.items():
+        hits, misses = counters_before[name]
+        stats[f'{name}_hits'] += cache.hits - hits
+        stats[f'{name}_misses'] += cache.misses - misses
+    return stats
@@ -24,67 +24,105 @@ def calculate_average_size(bounding_boxes):
     return average_width, average_height
 
 
-def get_scaled_image(ins_img, mask_img, bg_img, args, bg_data_dict: dict = None):
+def get_reference_size(bg_annotation, categories, mode='mean', rng=random):
     """
-    :param mask_img:
-    :param ins_img:
-    :param bg_img:
+    自动缩放时作为参照的目标尺寸
+    :param bg_annotation: 合成图当前的标注（annotation_tools.CompositeAnnotation）
+    :param categories: 参照的类别
+    :param mode: 'mean'：给定类别全部bbox的平均宽高；'median'：宽高的中位数；
+                 'sample'：从给定类别的bbox中随机抽取一个，按其宽高缩放，使缩放后的尺寸服从背景上真实的尺寸分布
+    :param rng: 随机数生成器（random.Random），默认使用random模块的全局状态
+    :return: (width, height)；给定类别没有任何bbox时返回None
+    """
+    if mode == 'mean':
+        return bg_annotation.get_mean_size(categories)
+    if mode == 'median':
+        return bg_annotation.get_median_size(categories)
+    sizes = bg_annotation.get_box_sizes(categories)
+    if not len(sizes):
+        return None
+    return tuple(sizes[rng.randrange(len(sizes))])
+
+
+def get_scaled_size(ins_size, bg_size, args, bg_annotation=None, rng=random):
+    """
+    只根据尺寸决定instance缩放后的大小，无需解码图片
+    :param ins_size: instance原始(width, height)
+    :param bg_size: 背景图(width, height)
     :param args:
-    :param bg_data_dict:
-    :return:
+    :param bg_annotation: 合成图当前的标注（annotation_tools.CompositeAnnotation）
+    :param rng: 随机数生成器（random.Random），默认使用random模块的全局状态
+    :return: 缩放后的(width, height)
     """
-    if (not args.manual_scaling) and bg_data_dict['instances']:
+    ins_width, ins_height = ins_size
+    reference_size = None
+    if (not args.manual_scaling) and bg_annotation is not None and bg_annotation.num_boxes:
         if not args.classes_for_autoscaling:
-            specified_classes = bg_data_dict["exist_category"]
-            for sp_class in specified_classes:
-                if sp_class not in bg_data_dict["exist_category"]:
-                    specified_classes.remove(sp_class)
+            specified_classes = bg_annotation.exist_category
         else:
 
             specified_classes = args.classes_for_autoscaling
-        specified_boxes_dict = {category: bg_data_dict["instances"][category]
-                                for category in specified_classes}
-        average_width, average_height = calculate_average_size(specified_boxes_dict)
+        reference_size = get_reference_size(bg_annotation, specified_classes, args.autoscaling_mode, rng)
+
+    if reference_size is not None:
+        reference_width, reference_height = reference_size
 
-        # Calculate the scaling factor based on the average size
-        min_scaling_factor = min(average_width / ins_img.width, average_height / ins_img.height)
-        max_scaling_factor = max(average_width / ins_img.width, average_height / ins_img.height)
+        # Calculate the scaling factor based on the reference size
+        min_scaling_factor = min(reference_width / ins_width, reference_height / ins_height)
+        max_scaling_factor = max(reference_width / ins_width, reference_height / ins_height)
     else:
         # 目标图乘以conjugate_scale_factor后，恰好保证每条边都小于等于背景图大小。用于锚定缩放比例
-        conjugate_scale_factor = min(bg_img.width / ins_img.width, bg_img.height / ins_img.height)
+        conjugate_scale_factor = min(bg_size[0] / ins_width, bg_size[1] / ins_height)
 
         min_scaling_factor = conjugate_scale_factor * args.min_scaling_factor
         max_scaling_factor = conjugate_scale_factor * args.max_scaling_factor
 
-    assert 0 < args.min_scaling_factor <= args.max_scaling_factor <= 1
-    scaling_factor = random.uniform(min_scaling_factor, max_scaling_factor)
+    # 缩放比例上下限的合法性由run_paste.check_args在启动时检查一次
+    scaling_factor = rng.uniform(min_scaling_factor, max_scaling_factor)
 
     # Scale the new object images
-    new_width = int(ins_img.width * scaling_factor)
-    new_height = int(ins_img.height * scaling_factor)
-    if args.resample_method == 'LANCZOS':
-        scaled_ins_image = ins_img.resize((new_width, new_height), resample=Image.Resampling.LANCZOS)
+    return int(ins_width * scaling_factor), int(ins_height * scaling_factor)
+
+
+def resize_instance(ins_img, mask_img, new_size, resample_method, pyramid=None):
+    """
+    :param ins_img:
+    :param mask_img: 可为None
+    :param new_size: 缩放后的(width, height)
+    :param resample_method: 'LANCZOS'、'BILINEAR'或'BICUBIC'
+    :param pyramid: 预先缩小的[(图片, mask), ...]，由大到小（见cache_tools.InstanceCache）。
+                    若给定，则从不小于目标尺寸的最小一级开始缩放
+    :return: 缩放后的instance与mask（没有mask时为None）
+    """
+    new_width, new_height = new_size
+    src_ins_img, src_mask_img = ins_img, mask_img
+    for level_img, level_mask in (pyramid or ()):
+        if level_img.width < new_width or level_img.height < new_height:
+            break
+        src_ins_img, src_mask_img = level_img, level_mask
+    if resample_method == 'LANCZOS':
+        scaled_ins_image = src_ins_img.resize((new_width, new_height), resample=Image.Resampling.LANCZOS)
         if mask_img:
-            scaled_mask_img = mask_img.resize(scaled_ins_image.size, resample=Image.Resampling.LANCZOS)
+            scaled_mask_img = src_mask_img.resize(scaled_ins_image.size, resample=Image.Resampling.LANCZOS)
             assert scaled_ins_image.size == scaled_mask_img.size
             # scaled_mask_img = mask_img.resize((new_width, new_height), resample=Image.Resampling.LANCZOS)
             # assert ins_img.size == mask_img.size
     else:
-        if args.resample_method == 'BILINEAR':
-            scaled_ins_image = ins_img.resize((new_width, new_height), resample=Image.Resampling.BILINEAR)
+        if resample_method == 'BILINEAR':
+            scaled_ins_image = src_ins_img.resize((new_width, new_height), resample=Image.Resampling.BILINEAR)
             if mask_img:
-                scaled_mask_img = mask_img.resize((new_width, new_height), resample=Image.Resampling.BILINEAR)
+                scaled_mask_img = src_mask_img.resize((new_width, new_height), resample=Image.Resampling.BILINEAR)
                 assert ins_img.size == mask_img.size
         else:
-            if args.resample_method == 'BICUBIC':
-                scaled_ins_image = ins_img.resize((new_width, new_height), resample=Image.Resampling.BICUBIC)
+            if resample_method == 'BICUBIC':
+                scaled_ins_image = src_ins_img.resize((new_width, new_height), resample=Image.Resampling.BICUBIC)
                 if mask_img:
-                    scaled_mask_img = mask_img.resize((new_width, new_height), resample=Image.Resampling.BICUBIC)
+                    scaled_mask_img = src_mask_img.resize((new_width, new_height), resample=Image.Resampling.BICUBIC)
                     assert ins_img.size == mask_img.size
             else:
-                scaled_ins_image = ins_img.resize((new_width, new_height))
+                scaled_ins_image = src_ins_img.resize((new_width, new_height))
                 if mask_img:
-                    scaled_mask_img = mask_img.resize((new_width, new_height))
+                    scaled_mask_img = src_mask_img.resize((new_width, new_height))
                     assert ins_img.size == mask_img.size
     if not mask_img:
         scaled_mask_img = None
@@ -92,60 +130,238 @@ def get_scaled_image(ins_img, mask_img, bg_img, args, bg_data_dict: dict = None)
     return scaled_ins_image, scaled_mask_img
 
 
+def get_cv2_interpolation(resample_method, downscale):
+    """
+    :param resample_method: 'LANCZOS'、'BILINEAR'或'BICUBIC'
+    :param downscale: 是否为缩小。OpenCV的其他插值方法缩小时不做抗锯齿，缩小时一律使用INTER_AREA
+    """
+    import cv2
+
+    if downscale:
+        return cv2.INTER_AREA
+    return {'LANCZOS': cv2.INTER_LANCZOS4, 'BICUBIC': cv2.INTER_CUBIC}.get(resample_method, cv2.INTER_LINEAR)
+
+
+def make_instance_buffer(ins_img, mask_img=None):
+    """
+    将instance与mask合并为一个uint8数组（mask为最后一个通道），OpenCV后端一次缩放即可同时得到instance与mask
+    :return: (数组，形状为(h, w)、(h, w, 2)、(h, w, 3)或(h, w, 4), instance的颜色模式'L'或'RGB')
+    """
+    color_mode = 'L' if ins_img.mode == 'L' else 'RGB'
+    color = to_array(ins_img, color_mode)
+    if mask_img is None:
+        return np.ascontiguousarray(color), color_mode
+    if mask_img.size != ins_img.size:
+        # controlnet生成的图片可能与mask尺寸不同
+        mask_img = mask_img.resize(ins_img.size, resample=Image.Resampling.LANCZOS)
+    return np.dstack([color, to_array(mask_img, 'L')]), color_mode
+
+
+def convert_array(array, mode, target_mode):
+    """
+    在L、RGB、RGBA之间转换uint8数组，规则与PIL的convert一致
+    """
+    if mode == target_mode:
+        return array
+    return np.asarray(Image.fromarray(np.ascontiguousarray(array), mode).convert(target_mode))
+
+
+def resize_instances(sources, new_sizes, resample_method, canvas_mode, backend='pil'):
+    """
+    一张合成图上全部instance的缩放阶段。在确定所有instance的尺寸与位置之后一次性缩放，
+    直接输出可供paste_array粘贴的数组，中间不再经过PIL图像之间的转换
+    :param sources: InstanceCache.get的返回值列表，见cache_tools.InstanceCache
+    :param new_sizes: 各instance缩放后的(width, height)
+    :param resample_method: 'LANCZOS'、'BILINEAR'或'BICUBIC'
+    :param canvas_mode: 背景数组的模式，instance会转换为该模式
+    :param backend: 'pil'：instance与mask分别用PIL缩放，结果与resize_instance一致；
+                    'cv2'：instance与mask合并为一个多通道数组，由OpenCV一次缩放，速度快数倍，结果与PIL略有差异
+    :return: [(instance数组, alpha数组或None), ...]
+    """
+    scaled = []
+    for source, (new_width, new_height) in zip(sources, new_sizes):
+        if backend == 'cv2':
+            import cv2
+
+            levels, color_mode, has_mask = source
+            # 从不小于目标尺寸的最小一级开始缩放
+            buffer = levels[0]
+            for level in levels[1:]:
+                if level.shape[1] < new_width or level.shape[0] < new_height:
+                    break
+                buffer = level
+            downscale = new_width < buffer.shape[1] or new_height < buffer.shape[0]
+            out = cv2.resize(buffer, (new_width, new_height),
+                             interpolation=get_cv2_interpolation(resample_method, downscale))
+            if has_mask:
+                color, alpha = (out[..., 0], out[..., 1]) if color_mode == 'L' else (out[..., :3], out[..., 3])
+            else:
+                color, alpha = out, None
+            scaled.append((convert_array(color, color_mode, canvas_mode), alpha))
+        else:
+            ins_img, mask_img, pyramid = source
+            scaled_ins_img, scaled_mask_img = resize_instance(
+                ins_img, mask_img, (new_width, new_height), resample_method, pyramid)
+            scaled.append((to_array(scaled_ins_img, canvas_mode),
+                           to_array(scaled_mask_img, 'L') if scaled_mask_img is not None else None))
+    return scaled
+
+
+def get_scaled_image(ins_img, mask_img, bg_img, args, bg_annotation=None, pyramid=None):
+    """
+    :param mask_img:
+    :param ins_img:
+    :param bg_img:
+    :param args:
+    :param bg_annotation: 合成图当前的标注（annotation_tools.CompositeAnnotation）
+    :param pyramid: 见resize_instance
+    :return:
+    """
+    new_size = get_scaled_size(ins_img.size, bg_img.size, args, bg_annotation)
+    return resize_instance(ins_img, mask_img, new_size, args.resample_method, pyramid)
+
+
 @NotImplementedError
 def visualize_bbox():
     raise NotImplementedError
 
 
-def is_overlap(box1, box2):
-    for coord1 in box1:
-        for coord2 in box2:
-            x1_min, y1_min, x1_max, y1_max = min(coord1[0::2]), min(coord1[1::2]), max(coord1[0::2]), max(coord1[1::2])
-            x2_min, y2_min, x2_max, y2_max = min(coord2[0::2]), min(coord2[1::2]), max(coord2[0::2]), max(coord2[1::2])
-            if not (x1_max < x2_min or x1_min > x2_max or y1_max < y2_min or y1_min > y2_max):
-                return True
-    return False
+def get_box_extents(boxes):
+    """
+    将bbox转为轴对齐外接框。每张合成图只需计算一次，之后每次尝试坐标都直接与该数组比较
+    :param boxes: bbox列表或(N, 8)数组，每个bbox为[x1, y1, ..., x4, y4]；也可以是category -> bbox列表的dict
+    :return: (N, 4)数组，每行为[x_min, y_min, x_max, y_max]
+    """
+    if isinstance(boxes, dict):
+        box_arrays = [np.asarray(b, dtype=np.float64).reshape(-1, 8) for b in boxes.values()]
+        boxes = np.concatenate(box_arrays) if box_arrays else np.zeros((0, 8))
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 8)
+    return np.stack([boxes[:, 0::2].min(axis=1), boxes[:, 1::2].min(axis=1),
+                     boxes[:, 0::2].max(axis=1), boxes[:, 1::2].max(axis=1)], axis=1)
+
+
+def is_overlap_batch(candidate_extents, existing_extents, tolerance=None, metric='ioa'):
+    """
+    一次性判断一批候选框是否与任一已有框重叠
+    :param candidate_extents: (M, 4)数组，候选框[x_min, y_min, x_max, y_max]
+    :param existing_extents: (N, 4)数组，已有框
+    :param tolerance: 为None时使用严格规则，边界接触也视为重叠；否则重叠程度不超过tolerance即视为不重叠
+    :param metric: 重叠程度的计算方式。'iou'：交并比；'ioa'：交集占两框中较小者面积的比例
+    :return: (M,)布尔数组，True表示与至少一个已有框重叠
+    """
+    candidate_extents = np.asarray(candidate_extents, dtype=np.float64).reshape(-1, 4)
+    existing_extents = np.asarray(existing_extents, dtype=np.float64).reshape(-1, 4)
+    if not len(existing_extents):
+        return np.zeros(len(candidate_extents), dtype=np.bool_)
+    c = candidate_extents[:, None, :]
+    e = existing_extents[None, :, :]
+    if tolerance is None:
+        touching = ~((c[..., 2] < e[..., 0]) | (c[..., 0] > e[..., 2]) |
+                     (c[..., 3] < e[..., 1]) | (c[..., 1] > e[..., 3]))
+        return touching.any(axis=1)
+
+    inter_w = np.clip(np.minimum(c[..., 2], e[..., 2]) - np.maximum(c[..., 0], e[..., 0]), 0, None)
+    inter_h = np.clip(np.minimum(c[..., 3], e[..., 3]) - np.maximum(c[..., 1], e[..., 1]), 0, None)
+    inter = inter_w * inter_h
+    c_area = (c[..., 2] - c[..., 0]) * (c[..., 3] - c[..., 1])
+    e_area = (e[..., 2] - e[..., 0]) * (e[..., 3] - e[..., 1])
+    if metric == 'iou':
+        denominator = c_area + e_area - inter
+    elif metric == 'ioa':
+        denominator = np.minimum(c_area, e_area)
+    else:
+        raise ValueError(f"不支持的重叠计算方式：{metric}")
+    ratio = np.divide(inter, denominator, out=np.zeros_like(inter), where=denominator > 0)
+    return (ratio > tolerance).any(axis=1)
+
+
+def is_overlap(box1, box2, tolerance=None, metric='ioa'):
+    """
+    :param box1: bbox列表或(N, 8)数组
+    :param box2: bbox列表或(N, 8)数组
+    :return: box1中是否有任一bbox与box2中任一bbox重叠，规则见is_overlap_batch
+    """
+    return bool(is_overlap_batch(get_box_extents(box1), get_box_extents(box2), tolerance, metric).any())
 
 
-def find_non_overlapping_position(ins_img_size, bg_img_size, existing_bounding_boxes, max_attempts):
+def find_non_overlapping_position(ins_img_size, bg_img_size, existing_bounding_boxes, max_attempts,
+                                  tolerance=None, metric='ioa', rng=random):
+    """
+    随机尝试粘贴坐标，直到与所有已有bbox都不重叠
+    :param existing_bounding_boxes: category -> bbox列表的dict，或get_box_extents得到的(N, 4)数组
+    :param tolerance: 允许的重叠程度，见is_overlap_batch
+    :param metric: 重叠程度的计算方式，见is_overlap_batch
+    :param rng: 随机数生成器（random.Random），默认使用random模块的全局状态
+    """
     max_attempts = 1000 if max_attempts is None else max_attempts  # 调整每个目标粘贴时在背景图片上尝试最大次数
 
     # 如果目标图比背景图大，全部返回None
     if bg_img_size[0] - ins_img_size[0] < 0 or bg_img_size[1] - ins_img_size[1] < 0:
         return None, None
-    for _ in range(max_attempts):
-        x = random.randint(0, bg_img_size[0] - ins_img_size[0])
-        y = random.randint(0, bg_img_size[1] - ins_img_size[1])
-
-        new_box = [
-            [x, y, x + ins_img_size[0], y, x + ins_img_size[0], y + ins_img_size[1], x, y + ins_img_size[1]]
-        ]
-
-        # 检查是否与任何现存bbox重叠
-        if existing_bounding_boxes:
-            overlap = any(
-                is_overlap(new_box, existing_bounding_boxes[category]) for category in existing_bounding_boxes.keys())
-        else:
-            overlap = False
-
-        if not overlap:
-            return x, y
+    if isinstance(existing_bounding_boxes, np.ndarray):
+        existing_extents = existing_bounding_boxes
+    else:
+        existing_extents = get_box_extents(existing_bounding_boxes or {})
+
+    # 每批尝试的坐标一次性与所有已有bbox比较，批大小逐渐增加，以兼顾空旷背景与拥挤背景
+    batch_size = 1
+    attempts = 0
+    while attempts < max_attempts:
+        batch_size = min(batch_size, max_attempts - attempts)
+        xs = [rng.randint(0, bg_img_size[0] - ins_img_size[0]) for _ in range(batch_size)]
+        ys = [rng.randint(0, bg_img_size[1] - ins_img_size[1]) for _ in range(batch_size)]
+        candidates = np.array([xs, ys, xs, ys], dtype=np.float64).T
+        candidates[:, 2] += ins_img_size[0]
+        candidates[:, 3] += ins_img_size[1]
+        overlap = is_overlap_batch(candidates, existing_extents, tolerance, metric)
+        if not overlap.all():
+            first = int(np.argmin(overlap))
+            return xs[first], ys[first]
+        attempts += batch_size
+        batch_size = min(batch_size * 2, 1024)
 
     # 如果找不到或者超出最大尝试次数，全部返回None
     return None, None
 
 
-def get_some_instances(instance_img_path_list, img_num) -> list:
+def get_some_instances(instance_img_path_list, img_num, rng=random) -> list:
+    """
+    :param rng: 随机数生成器（random.Random），默认使用random模块的全局状态
+    """
     ins_list = []
     if img_num > len(instance_img_path_list):
         img_num = len(instance_img_path_list)
-    random_ins_names = random.sample(instance_img_path_list, img_num)
+    random_ins_names = rng.sample(instance_img_path_list, img_num)
     for ins_name in random_ins_names:
         ins_list.append(ins_name)
 
     return ins_list
 
 
+def get_paste_bbox(coord, ins_size):
+    """
+    :param coord: 粘贴位置(x, y)
+    :param ins_size: instance的(width, height)
+    :return: instance的bounding box，[x1, y1, x2, y2, x3, y3, x4, y4]
+    """
+    x, y = coord
+    new_width, new_height = ins_size
+
+    x1 = x
+    y1 = y
+
+    x2 = x + new_width
+    y2 = y
+
+    x3 = x + new_width
+    y3 = y + new_height
+
+    x4 = x
+    y4 = y + new_height
+
+    return [x1, y1, x2, y2, x3, y3, x4, y4]
+
+
 def paste_img_or_mask(ins_img, bg_img, coord, mask_for_ins=None):
     """
     注意：如果需要粘贴mask，传入一张黑色图片或者已经粘贴了数个mask的黑色图即可
@@ -161,22 +377,84 @@ def paste_img_or_mask(ins_img, bg_img, coord, mask_for_ins=None):
         bg_img.paste(ins_img, coord)
 
     # 返回bbox
-    x, y = coord
-    new_width, new_height = ins_img.size
+    return bg_img, get_paste_bbox(coord, ins_img.size)
 
-    x1 = x
-    y1 = y
 
-    x2 = x + new_width
-    y2 = y
+# NumPy合成时背景图数组支持的模式，其他模式的背景先转为RGB
+ARRAY_MODES = ('L', 'RGB', 'RGBA')
 
-    x3 = x + new_width
-    y3 = y + new_height
 
-    x4 = x
-    y4 = y + new_height
+def load_image_array(img_path):
+    """
+    读取图片为可写的uint8数组，供paste_array原地合成
+    :return: (H, W)或(H, W, C)数组，对应L、RGB或RGBA模式
+    """
+    with Image.open(img_path) as img:
+        if img.mode not in ARRAY_MODES:
+            img = img.convert('RGB')
+        return np.array(img)
+
 
-    return bg_img, [x1, y1, x2, y2, x3, y3, x4, y4]
+def get_array_mode(array):
+    """
+    :return: 数组对应的PIL模式，'L'、'RGB'或'RGBA'
+    """
+    return 'L' if array.ndim == 2 else ARRAY_MODES[array.shape[2] - 2]
+
+
+def to_array(img, mode):
+    """
+    将PIL图像转为指定模式的uint8数组，与PIL.Image.paste粘贴前的模式转换一致
+    """
+    return np.asarray(img if img.mode == mode else img.convert(mode))
+
+
+def paste_array(canvas, ins_array, coord, alpha=None, mask_canvas=None, labels=()):
+    """
+    在背景数组上原地粘贴instance，只访问instance所在区域，开销与instance面积成正比，不会分配背景大小的临时数组。
+    有alpha时按 (ins * alpha + bg * (255 - alpha)) / 255 四舍五入混合，结果与PIL.Image.paste(ins, coord, mask)逐像素一致
+    :param canvas: 背景图数组，(H, W)或(H, W, C)的uint8数组，原地修改
+    :param ins_array: instance数组，形状为(h, w)或(h, w, C)，通道数与canvas一致
+    :param coord: 左上角坐标(x, y)，超出背景的部分会被裁掉
+    :param alpha: instance的(h, w) uint8 mask，为None时整块覆盖
+    :param mask_canvas: 合成图mask数组(H, W)，给定且有alpha时，同一次粘贴中将alpha写入对应区域
+    :param labels: [(标签图数组(H, W), 标签值), ...]，如instance-ID图与类别ID图。
+                   同一次粘贴中，在alpha >= 128（与二值mask的阈值一致）的像素上写入标签值；没有alpha时整块写入
+    :return: instance的bounding box，[x1, y1, x2, y2, x3, y3, x4, y4]
+    """
+    x, y = coord
+    h, w = ins_array.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, canvas.shape[1]), min(y + h, canvas.shape[0])
+    if x0 < x1 and y0 < y1:
+        src = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+        roi = canvas[y0:y1, x0:x1]
+        if alpha is None:
+            roi[...] = ins_array[src]
+            for label_canvas, value in labels:
+                label_canvas[y0:y1, x0:x1] = value
+        else:
+            roi_alpha = alpha[src]
+            # 预先展开到与通道数一致，逐元素运算比广播快得多
+            a = (roi_alpha if canvas.ndim == 2 else np.repeat(roi_alpha[..., None], canvas.shape[2], axis=2)
+                 ).astype(np.uint16)
+            # 最大值255 * 255 + 255 + 128不超过uint16范围。除以255的方式与PIL相同：(t + (t >> 8)) >> 8
+            blended = np.multiply(ins_array[src], a, dtype=np.uint16)
+            np.subtract(255, a, out=a)
+            a *= roi
+            blended += a
+            blended += 128
+            np.right_shift(blended, 8, out=a)
+            blended += a
+            blended >>= 8
+            np.copyto(roi, blended, casting='unsafe')
+            if mask_canvas is not None:
+                mask_canvas[y0:y1, x0:x1] = roi_alpha
+            if labels:
+                foreground = roi_alpha >= 128
+                for label_canvas, value in labels:
+                    label_canvas[y0:y1, x0:x1][foreground] = value
+    return get_paste_bbox(coord, (w, h))
 
 
 def create_cropped_images(input_path):
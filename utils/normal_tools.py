@@ -3,13 +3,13 @@ import os
 import time
 from datetime import datetime
 
-import pytz
-
 
 def get_format_beijing_time():
     """
     生成基于当前北京时间的字符串，形如：2023-11-03-12-12-59
     """
+    import pytz
+
     tz = pytz.timezone("Asia/Shanghai")
     bj_time = datetime.fromtimestamp(int(time.time()), tz).strftime("%Y-%m-%d-%H-%M-%S")
     # current_time = datetime.now()
@@ -17,13 +17,14 @@ def get_format_beijing_time():
     return bj_time
 
 
-def get_folders(project_folder: str, time_now: str, ins_category: list, no_mask: bool = False):
+def get_folders(project_folder: str, run_name: str, ins_category: list, no_mask: bool = False):
     """
     返回 background、instance(基于args.ins_category的list)、instance_masks(基于args.ins_category的list)、
-    composite、composite_mask、composite_label文件夹，同时自动创建输出文件夹
+    composite、composite_mask、composite_label文件夹。
+    只返回路径，不创建输出文件夹，输出文件夹在实际写出文件时才创建（见CompositeNameAllocator.get_path）
     :param no_mask: 是否包含mask路径
     :param project_folder: 整个图片项目的最外层文件夹
-    :param time_now: 时间戳（字符串）
+    :param run_name: 本次运行的输出文件夹名，如"2023-11-03-12-12-59-1a2b3c4d"（时间戳加运行ID）
     :param ins_category: 准备后续粘贴的类别名称。如果为None则默认将文件夹内全选
     :return:分别为 background(str)、instance(list)、instance_masks(list)、composite_img(str)、
             composite_mask(str) 、composite_label(str)文件夹路径
@@ -35,23 +36,76 @@ def get_folders(project_folder: str, time_now: str, ins_category: list, no_mask:
                        for class_name in ins_category]
     ins_mask_folder_list = [os.path.join(project_folder, 'instances', class_name, 'masks')
                             for class_name in ins_category]
-    composite_save_folder = os.path.join(project_folder, 'output', time_now, 'composites')
-    comp_mask_folder = os.path.join(project_folder, 'output', time_now, 'masks')
-    composite_label_folder = os.path.join(project_folder, 'output', time_now, 'labels')
-
-    os.makedirs(composite_save_folder, exist_ok=True)
-    os.makedirs(composite_label_folder, exist_ok=True)
-    if not no_mask:
-        os.makedirs(comp_mask_folder, exist_ok=True)
+    composite_save_folder = os.path.join(project_folder, 'output', run_name, 'composites')
+    comp_mask_folder = os.path.join(project_folder, 'output', run_name, 'masks')
+    composite_label_folder = os.path.join(project_folder, 'output', run_name, 'labels')
 
     return bg_folder, ins_folder_list, ins_mask_folder_list, composite_save_folder, comp_mask_folder, composite_label_folder
 
 
-def get_ins_mask_dir(ins_path):
-    ins_name = os.path.basename(ins_path)
-    mask_folder = os.path.join(os.path.dirname(os.path.dirname(ins_path)), 'masks')
-    ins_pref, ins_surf = os.path.splitext(os.path.basename(os.path.join(mask_folder, ins_name)))
+class CompositeNameAllocator:
+    """
+    合成图输出文件命名。文件编号直接由合成图序号决定，形如composite_1227_15.png，
+    不需要每次列出输出文件夹计数，开销恒定；不同进程负责的序号互不重叠，同时写入也不会重名。
+    输出文件均以独占方式创建（见output_tools），万一重名会直接报错，不会覆盖已有文件。
+    shard_size大于0时，按编号每shard_size个文件放入一个子文件夹，避免单个文件夹内文件过多
+    """
+
+    def __init__(self, month_date_str, index_offset=0, shard_size=0):
+        """
+        :param month_date_str: 月份日期字符串，如"1227"
+        :param index_offset: 编号偏移。多个任务写入同一文件夹时，各自使用不重叠的编号范围
+        :param shard_size: 每个子文件夹内的文件数，为0时不分子文件夹
+        """
+        self.month_date_str = month_date_str
+        self.index_offset = index_offset
+        self.shard_size = shard_size
+        self._created_folders = set()
+
+    def get_name(self, index):
+        """
+        :param index: 合成图序号（从0开始）
+        :return: (子文件夹名，不分子文件夹时为空字符串, 不含后缀的文件名)
+        """
+        number = index + self.index_offset + 1
+        shard = f"{(number - 1) // self.shard_size:05d}" if self.shard_size > 0 else ''
+        return shard, f"composite_{self.month_date_str}_{number}"
+
+    def get_path(self, folder, index, suffix):
+        """
+        :param folder: 输出文件夹，如composites、masks文件夹
+        :param index: 合成图序号（从0开始）
+        :param suffix: 文件名后缀，如".png"、"_mask.png"
+        :return: 输出文件路径。所在文件夹不存在时会自动创建（每个文件夹只检查一次）
+        """
+        shard, file_stem = self.get_name(index)
+        out_folder = os.path.join(folder, shard) if shard else folder
+        if out_folder not in self._created_folders:
+            os.makedirs(out_folder, exist_ok=True)
+            self._created_folders.add(out_folder)
+        return os.path.join(out_folder, file_stem + suffix)
+
+
+def _split_mask_lookup(ins_path, controlnet_gen_data=False):
+    """
+    :return: (instance对应的masks文件夹, 用于匹配mask的instance名称（不含后缀）)
+    """
+    if controlnet_gen_data:
+        # controlnet数据中，每张instance图片位于以其名称命名的文件夹内
+        ins_name = os.path.basename(os.path.dirname(ins_path))
+        mask_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(ins_path))), "masks")
+    else:
+        ins_name = os.path.basename(ins_path)
+        mask_folder = os.path.join(os.path.dirname(os.path.dirname(ins_path)), 'masks')
+    ins_pref, ins_surf = os.path.splitext(ins_name)
+    return mask_folder, ins_pref
+
 
+def _find_mask_path(mask_folder, ins_pref, mask_file_names=None):
+    """
+    按固定优先级匹配mask文件名
+    :param mask_file_names: masks文件夹内全部文件名的集合。给定时直接查集合，不再逐个访问文件系统
+    """
     if '_mask' in ins_pref:
         alt_pref = ins_pref.replace('_mask', '')
     else:
@@ -64,39 +118,54 @@ def get_ins_mask_dir(ins_path):
     possible_mask_surfix = ['', 'mask', '_mask']
     for mask_surfix in possible_mask_surfix:
         for surfix in possible_file_surfix:
-            possible_file_path = os.path.join(mask_folder, alt_pref + mask_surfix + surfix)
-            if os.path.exists(possible_file_path):
-                return possible_file_path
+            file_name = alt_pref + mask_surfix + surfix
+            if mask_file_names is not None:
+                found = file_name in mask_file_names
+            else:
+                found = os.path.exists(os.path.join(mask_folder, file_name))
+            if found:
+                return os.path.join(mask_folder, file_name)
 
     return None
 
 
-def get_ctrlnet_ins_mask_dir(ins_path):
-    ins_name = os.path.basename(os.path.dirname(ins_path))
-    mask_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(ins_path))), "masks")
-    ins_pref, ins_surf = os.path.splitext(os.path.basename(os.path.join(mask_folder, ins_name)))
+def get_ins_mask_dir(ins_path, mask_file_names=None):
+    mask_folder, ins_pref = _split_mask_lookup(ins_path)
+    return _find_mask_path(mask_folder, ins_pref, mask_file_names)
 
-    if '_mask' in ins_pref:
-        alt_pref = ins_pref.replace('_mask', '')
-    else:
-        if 'mask' in ins_pref:
-            alt_pref = ins_pref.replace('mask', '')
-        else:
-            alt_pref = ins_pref
 
-    possible_file_surfix = ['.jpg', '.jpeg', '.png']
-    possible_mask_surfix = ['', 'mask', '_mask']
-    for mask_surfix in possible_mask_surfix:
-        for surfix in possible_file_surfix:
-            possible_file_path = os.path.join(mask_folder, alt_pref + mask_surfix + surfix)
-            if os.path.exists(possible_file_path):
-                return possible_file_path
+def get_ctrlnet_ins_mask_dir(ins_path, mask_file_names=None):
+    mask_folder, ins_pref = _split_mask_lookup(ins_path, controlnet_gen_data=True)
+    mask_path = _find_mask_path(mask_folder, ins_pref, mask_file_names)
+    if mask_path is None:
+        raise FileNotFoundError(f"{os.path.basename(os.path.dirname(ins_path))}图片的mask未找到")
+    return mask_path
 
-    raise FileNotFoundError(f"{ins_name}图片的mask未找到")
 
-
-def json_to_yolov8(json_data, out_path, yolo_class_index_list):
+def build_ins_mask_map(ins_path_list, controlnet_gen_data=False):
+    """
+    启动时一次性为所有instance匹配mask。每个masks文件夹只列出一次，之后按文件名集合匹配，不再逐个访问文件系统
+    :param ins_path_list: 全部instance图片路径
+    :param controlnet_gen_data: 是否为controlnet数据的文件夹格式
+    :return: (dict，instance路径 -> mask路径（找不到时为None）, 找不到mask的instance路径列表)
+    """
+    folder_file_names = {}
+    ins_mask_map = {}
+    unmatched = []
+    for ins_path in ins_path_list:
+        mask_folder, ins_pref = _split_mask_lookup(ins_path, controlnet_gen_data)
+        if mask_folder not in folder_file_names:
+            folder_file_names[mask_folder] = set(os.listdir(mask_folder)) if os.path.isdir(mask_folder) else set()
+        mask_path = _find_mask_path(mask_folder, ins_pref, folder_file_names[mask_folder])
+        ins_mask_map[ins_path] = mask_path
+        if mask_path is None:
+            unmatched.append(ins_path)
+    return ins_mask_map, unmatched
+
+
+def get_yolov8_lines(json_data, yolo_class_index_list):
     """
+    将json标注转为yolo格式的文本行（不含换行符）
     yolo_class_index_list: 一个列表，包含着所有需要检测的目标，按顺序排列。这样可以确定写入txt时class的编号
     """
     if isinstance(json_data, str):
@@ -109,20 +178,31 @@ def json_to_yolov8(json_data, out_path, yolo_class_index_list):
     bg_width = data["bg_img_info"]["bg_width"]
     bg_height = data["bg_img_info"]["bg_height"]
 
+    lines = []
+    for category in data["exist_category"]:
+        if category in data["instances"]:
+            for instance in data["instances"][category]:
+                x_min = min(instance[0], instance[2], instance[4], instance[6])
+                y_min = min(instance[1], instance[3], instance[5], instance[7])
+                x_max = max(instance[0], instance[2], instance[4], instance[6])
+                y_max = max(instance[1], instance[3], instance[5], instance[7])
+
+                x_center = (x_min + x_max) / 2.0 / bg_width
+                y_center = (y_min + y_max) / 2.0 / bg_height
+                width = (x_max - x_min) / bg_width
+                height = (y_max - y_min) / bg_height
+
+                if category not in yolo_class_index_list:
+                    raise AttributeError(f"需要在args.yolo_class_list中按照yolo目标index顺序添加{category}类")
+                lines.append(f"{yolo_class_index_list.index(category)} {x_center} {y_center} {width} {height}")
+    return lines
+
+
+def json_to_yolov8(json_data, out_path, yolo_class_index_list):
+    """
+    yolo_class_index_list: 一个列表，包含着所有需要检测的目标，按顺序排列。这样可以确定写入txt时class的编号
+    """
+    lines = get_yolov8_lines(json_data, yolo_class_index_list)
     with open(out_path, 'w') as out_file:
-        for category in data["exist_category"]:
-            if category in data["instances"]:
-                for instance in data["instances"][category]:
-                    x_min = min(instance[0], instance[2], instance[4], instance[6])
-                    y_min = min(instance[1], instance[3], instance[5], instance[7])
-                    x_max = max(instance[0], instance[2], instance[4], instance[6])
-                    y_max = max(instance[1], instance[3], instance[5], instance[7])
-
-                    x_center = (x_min + x_max) / 2.0 / bg_width
-                    y_center = (y_min + y_max) / 2.0 / bg_height
-                    width = (x_max - x_min) / bg_width
-                    height = (y_max - y_min) / bg_height
-
-                    if category not in yolo_class_index_list:
-                        raise AttributeError(f"需要在args.yolo_class_list中按照yolo目标index顺序添加{category}类")
-                    out_file.write(f"{yolo_class_index_list.index(category)} {x_center} {y_center} {width} {height}\n")
+        for line in lines:
+            out_file.write(line + "\n")
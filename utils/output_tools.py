@@ -0,0 +1,357 @@
+import glob
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.normal_tools import get_yolov8_lines
+
+
+class OutputEncoding:
+    """
+    合成图与mask的保存格式。合成图可选png/jpg/webp及其压缩参数；mask始终无损保存为png，
+    可选RGB三通道、L单通道灰度或1位二值图
+    """
+    IMAGE_SUFFIX = {'png': '.png', 'jpg': '.jpg', 'webp': '.webp'}
+
+    def __init__(self, image_format='png', quality=95, png_compress_level=6, mask_mode='RGB'):
+        """
+        :param image_format: 合成图格式，'png'、'jpg'或'webp'
+        :param quality: jpg/webp的质量（1-100）
+        :param png_compress_level: png压缩等级（0-9），越小编码越快、文件越大
+        :param mask_mode: mask保存模式，'RGB'、'L'或'1'
+        """
+        assert image_format in self.IMAGE_SUFFIX, f"不支持的图片格式：{image_format}"
+        assert mask_mode in ('RGB', 'L', '1'), f"不支持的mask模式：{mask_mode}"
+        self.image_format = image_format
+        self.quality = quality
+        self.png_compress_level = png_compress_level
+        self.mask_mode = mask_mode
+
+    @property
+    def image_suffix(self):
+        return self.IMAGE_SUFFIX[self.image_format]
+
+    def save_image(self, img, path):
+        if self.image_format == 'png':
+            img.save(path, format='PNG', compress_level=self.png_compress_level)
+        elif self.image_format == 'jpg':
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            img.save(path, format='JPEG', quality=self.quality)
+        else:
+            img.save(path, format='WEBP', quality=self.quality)
+
+    def save_mask(self, mask_img, path):
+        """
+        :param mask_img: 灰度（L）或RGB mask
+        """
+        if self.mask_mode == '1':
+            # 不使用convert('1')，避免抖动
+            mask_img = mask_img.convert('L').point(lambda v: 255 if v >= 128 else 0, mode='1')
+        elif mask_img.mode != self.mask_mode:
+            mask_img = mask_img.convert(self.mask_mode)
+        mask_img.save(path, format='PNG', compress_level=self.png_compress_level)
+
+    def save_label_map(self, label_img, path):
+        """
+        无损保存instance-ID图（16位灰度，I;16）或类别ID图（8位灰度，L），像素值即为ID，不做任何转换
+        """
+        label_img.save(path, format='PNG', compress_level=self.png_compress_level)
+
+    def to_dict(self):
+        return {
+            'image_format': self.image_format,
+            'quality': self.quality,
+            'png_compress_level': self.png_compress_level,
+            'mask_mode': self.mask_mode,
+        }
+
+
+class RunMetadata:
+    """
+    本次运行的全部参数与输出格式，保存为输出文件夹下的run_config.json，便于复现与下游读取。
+    在第一张合成图写出前才创建输出文件夹并保存，运行出错或没有生成任何合成图时不会留下空的输出文件夹。
+    多个进程都会尝试保存，先写临时文件再以os.link独占地放到目标位置，只有一个进程写入成功，读到的文件总是完整的
+    """
+
+    def __init__(self, run_folder, args, encoding):
+        """
+        :param run_folder: 本次运行的输出文件夹
+        :param args: 运行参数
+        :param encoding: OutputEncoding
+        """
+        self.run_folder = run_folder
+        self.metadata = {'args': dict(vars(args)), 'output_encoding': encoding.to_dict()}
+        self._saved = False
+
+    def save_once(self):
+        """
+        保存run_config.json，每个进程内只在第一次调用时真正写出
+        """
+        if self._saved:
+            return
+        os.makedirs(self.run_folder, exist_ok=True)
+        path = os.path.join(self.run_folder, 'run_config.json')
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.metadata, f, indent=4, ensure_ascii=False)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass  # 其他进程已经保存过
+        finally:
+            os.remove(tmp_path)
+        self._saved = True
+
+
+def save_composite_outputs(encoding, composite_img, composite_path, mask_img, mask_path, bg_data_dict, json_path,
+                           yolo_path, yolo_class_list, label_maps=()):
+    """
+    保存一张合成图的全部输出：合成图、mask（可为None）、json标注与yolo标注。
+    所有文件均以独占方式（'x'）创建，目标文件已存在时抛出FileExistsError，不会覆盖其他任务的输出
+    :param encoding: OutputEncoding
+    :param label_maps: [(instance-ID图或类别ID图, 保存路径), ...]
+    """
+    with open(composite_path, 'xb') as f:
+        encoding.save_image(composite_img, f)
+    if mask_img is not None:
+        with open(mask_path, 'xb') as f:
+            encoding.save_mask(mask_img, f)
+    for label_img, label_path in label_maps:
+        with open(label_path, 'xb') as f:
+            encoding.save_label_map(label_img, f)
+    with open(json_path, 'x') as f:
+        json.dump(bg_data_dict, f, indent=4)
+    with open(yolo_path, 'x') as f:
+        for line in get_yolov8_lines(bg_data_dict, yolo_class_list):
+            f.write(line + "\n")
+
+
+class TarShardWriter:
+    """
+    WebDataset风格的分片输出。每张合成图的图片、mask与标注以同一个key（如composite_1227_15）写入同一个tar分片，
+    分片达到max_shard_bytes后换新分片，避免海量小文件。每个分片旁边有一个.idx索引文件（每行一个json），
+    记录每个成员在tar中的字节偏移，配合TarShardReader可以按key随机读取，也可以按顺序流式读取整个分片。
+
+    写入按reserve得到的序号依次进行，多个写出线程并行编码时，分片内的样本顺序仍与提交顺序一致
+    """
+
+    def __init__(self, shard_folder, max_shard_bytes):
+        """
+        :param shard_folder: 分片输出文件夹
+        :param max_shard_bytes: 单个分片的大小上限（字节）
+        """
+        self.shard_folder = shard_folder
+        self.max_shard_bytes = max_shard_bytes
+        self._tar = None
+        self._index_file = None
+        self._mtime = int(time.time())
+        self._condition = threading.Condition()
+        self._next_ticket = 0
+        self._next_to_write = 0
+
+    def reserve(self):
+        """
+        :return: 写入序号，须在提交写出任务时（按提交顺序）获取
+        """
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+        return ticket
+
+    def _open_shard(self, index):
+        os.makedirs(self.shard_folder, exist_ok=True)
+        # 以分片内第一个样本的编号命名，不同进程的分片不会重名；独占创建，重名时报错而不是覆盖
+        shard_path = os.path.join(self.shard_folder, f"shard-{index:09d}.tar")
+        self._tar = tarfile.open(shard_path, 'x', format=tarfile.USTAR_FORMAT)
+        self._index_file = open(shard_path + '.idx', 'x')
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._index_file.close()
+            self._tar = self._index_file = None
+
+    def write_sample(self, ticket, index, key, members):
+        """
+        :param ticket: reserve得到的序号；为None时表示该样本放弃写入，只让出顺序
+        :param index: 合成图序号
+        :param key: 样本key，作为各成员文件名的前缀
+        :param members: [(后缀, bytes), ...]，如[(".png", ...), (".json", ...)]
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._next_to_write == ticket)
+            try:
+                if members is not None:
+                    if self._tar is None:
+                        self._open_shard(index)
+                    offsets = {}
+                    for suffix, data in members:
+                        tar_info = tarfile.TarInfo(key + suffix)
+                        tar_info.size = len(data)
+                        tar_info.mtime = self._mtime
+                        self._tar.addfile(tar_info, io.BytesIO(data))
+                        # addfile后tar.offset位于补齐到512字节的数据块末尾
+                        offsets[suffix] = [self._tar.offset - (len(data) + 511) // 512 * 512, len(data)]
+                    self._index_file.write(json.dumps({'key': key, 'members': offsets}) + "\n")
+                    if self._tar.offset >= self.max_shard_bytes:
+                        self._close_shard()
+            finally:
+                self._next_to_write += 1
+                self._condition.notify_all()
+
+    def skip(self, ticket):
+        """
+        放弃序号对应的样本（提交写出任务失败时调用），避免后面的样本一直等待
+        """
+        self.write_sample(ticket, None, None, None)
+
+    def close(self):
+        with self._condition:
+            self._close_shard()
+
+
+class TarShardReader:
+    """
+    读取TarShardWriter写出的分片。支持按key随机读取单个样本，也支持按分片顺序流式遍历全部样本
+    """
+
+    def __init__(self, shard_folder):
+        self.shard_paths = sorted(glob.glob(os.path.join(shard_folder, 'shard-*.tar')))
+        self.index = {}
+        for shard_path in self.shard_paths:
+            with open(shard_path + '.idx', 'r') as f:
+                for line in f:
+                    record = json.loads(line)
+                    self.index[record['key']] = (shard_path, record['members'])
+
+    def keys(self):
+        return self.index.keys()
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, key):
+        """
+        :return: dict，后缀 -> bytes
+        """
+        shard_path, members = self.index[key]
+        sample = {}
+        with open(shard_path, 'rb') as f:
+            for suffix, (offset, size) in members.items():
+                f.seek(offset)
+                sample[suffix] = f.read(size)
+        return sample
+
+    def __iter__(self):
+        """
+        按顺序流式读取，逐个产出 (key, dict(后缀 -> bytes))
+        """
+        for shard_path in self.shard_paths:
+            key, sample = None, {}
+            with tarfile.open(shard_path, 'r|') as tar:
+                for member in tar:
+                    member_key, suffix = member.name.split('.', 1)
+                    if member_key != key and sample:
+                        yield key, sample
+                        sample = {}
+                    key = member_key
+                    sample['.' + suffix] = tar.extractfile(member).read()
+            if sample:
+                yield key, sample
+
+
+def save_composite_to_shard(shard_writer, ticket, index, key, encoding, composite_img, mask_img, bg_data_dict,
+                            yolo_class_list, label_maps=()):
+    """
+    编码一张合成图的全部输出，并写入tar分片。成员后缀为.<图片格式>、.mask.png、label_maps中的后缀、.json与.txt
+    :param shard_writer: TarShardWriter
+    :param ticket: shard_writer.reserve()得到的序号
+    :param label_maps: [(后缀, instance-ID图或类别ID图), ...]，如[(".ids.png", ...)]
+    """
+    members = None
+    try:
+        composite_bytes = io.BytesIO()
+        encoding.save_image(composite_img, composite_bytes)
+        encoded = [(encoding.image_suffix, composite_bytes.getvalue())]
+        if mask_img is not None:
+            mask_bytes = io.BytesIO()
+            encoding.save_mask(mask_img, mask_bytes)
+            encoded.append(('.mask.png', mask_bytes.getvalue()))
+        for suffix, label_img in label_maps:
+            label_bytes = io.BytesIO()
+            encoding.save_label_map(label_img, label_bytes)
+            encoded.append((suffix, label_bytes.getvalue()))
+        encoded.append(('.json', json.dumps(bg_data_dict, indent=4).encode('utf-8')))
+        yolo_lines = get_yolov8_lines(bg_data_dict, yolo_class_list)
+        encoded.append(('.txt', ''.join(line + "\n" for line in yolo_lines).encode('utf-8')))
+        members = encoded
+    finally:
+        # 编码出错时也要让出写入顺序（members为None），避免后面的样本一直等待
+        shard_writer.write_sample(ticket, index, key, members)
+
+
+class AsyncWriter:
+    """
+    后台写出阶段。PNG编码与写盘交给线程池完成（PIL编码时会释放GIL），生成循环提交后即可继续合成下一张图。
+    同时在写的任务数不超过max_pending，超出时submit会等待，以此限制积压的图片所占内存。
+    num_threads为0时退化为在调用线程内同步写出
+    """
+
+    def __init__(self, num_threads=2, max_pending=8):
+        """
+        :param num_threads: 写出线程数
+        :param max_pending: 最多同时积压的写出任务数
+        """
+        self._executor = ThreadPoolExecutor(num_threads) if num_threads > 0 else None
+        self._slots = threading.BoundedSemaphore(max(1, max_pending))
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._errors = []
+
+    def _on_done(self, future):
+        with self._lock:
+            self._pending.discard(future)
+            if future.exception() is not None:
+                self._errors.append(future.exception())
+        self._slots.release()
+
+    def _raise_errors(self):
+        with self._lock:
+            if self._errors:
+                error = self._errors[0]
+                self._errors.clear()
+                raise error
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        提交一个写出任务。积压任务数已达上限时等待，之前的任务出错时在此抛出
+        """
+        self._raise_errors()
+        if self._executor is None:
+            fn(*args, **kwargs)
+            return
+        self._slots.acquire()
+        future = self._executor.submit(fn, *args, **kwargs)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._on_done)
+
+    def flush(self):
+        """
+        等待所有已提交的任务写完，有任务出错时抛出
+        """
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            future.exception()  # 等待完成，异常统一由_raise_errors抛出
+        self._raise_errors()
+
+    def close(self):
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
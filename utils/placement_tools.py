@@ -0,0 +1,146 @@
+import random
+
+import numpy as np
+
+from utils.image_tools import find_non_overlapping_position, get_box_extents
+
+
+def _dilate(grid, size, axis):
+    """
+    沿一个方向做宽度为size的滑动窗口“或”运算（一维膨胀），窗口每次翻倍，只需约log2(size)次整幅布尔运算
+    :param grid: 二维布尔数组
+    :param size: 窗口宽度
+    :param axis: 0为沿y方向，1为沿x方向
+    :return: 布尔数组，沿axis的长度减少size - 1；[i]为grid[i:i + size]中是否有True
+    """
+    grid = np.moveaxis(grid, axis, 0)
+    span = 1
+    while span * 2 <= size:
+        grid = grid[:-span] | grid[span:]
+        span *= 2
+    length = grid.shape[0] - (size - span)
+    return np.moveaxis(grid[:length] | grid[size - span:size - span + length], 0, axis)
+
+
+class FreeSpaceSampler:
+    """
+    粘贴位置采样器。先做少量（REJECTION_ATTEMPTS次）批量随机尝试，背景不拥挤时几乎总能立即找到位置；
+    全部失败时再在占用栅格上一次性得到全部合法左上角坐标，从中均匀抽取。两种方式都是在同一个合法坐标集合上均匀抽取，
+    结果分布相同；没有合法位置时返回None，不会像拒绝采样那样一直尝试下去。
+
+    占用栅格每张合成图只在第一次需要时建立一次，之后每次粘贴在occupy中标记新bbox；采样时按instance尺寸对栅格做膨胀，
+    得到全部被禁止的左上角坐标，耗时只由背景大小决定，与背景上已有多少个bbox无关。
+
+    与find_non_overlapping_position的判定规则一致：新bbox与已有bbox不允许重叠，边界接触也视为重叠。
+    栅格以整数像素点为单位，浮点bbox会向外取整，因此结果只会比逐一比较更保守，不会产生重叠
+    """
+    # 回退到占用栅格前的随机尝试次数
+    REJECTION_ATTEMPTS = 64
+
+    def __init__(self, bg_img_size, existing_bounding_boxes=None, rng=random):
+        """
+        :param bg_img_size: 背景图(width, height)
+        :param existing_bounding_boxes: dict，category -> bbox列表或(N, 8)数组，每个bbox为[x1, y1, ..., x4, y4]
+        :param rng: 随机数生成器（random.Random），默认使用random模块的全局状态
+        """
+        self.width, self.height = bg_img_size
+        self.rng = rng
+        # 已占用区域，每行为向外取整并截断到背景内的[x_min, y_min, x_max, y_max]（闭区间）
+        self.extents = np.zeros((0, 4), dtype=np.int64)
+        self._occupancy = None  # (height + 1, width + 1)的布尔栅格，[y, x]为True表示像素点(x, y)已被占用
+        if existing_bounding_boxes:
+            for boxes in existing_bounding_boxes.values():
+                self.occupy(boxes)
+
+    def occupy(self, boxes):
+        """
+        将bbox覆盖的区域标记为已占用。每次粘贴后调用，更新可选位置集合
+        :param boxes: bbox列表或(N, 8)数组
+        """
+        extents = get_box_extents(boxes)
+        extents[:, :2] = np.floor(extents[:, :2])
+        extents[:, 2:] = np.ceil(extents[:, 2:])
+        # 完全位于背景之外的bbox不影响粘贴
+        inside = ((extents[:, 2] >= 0) & (extents[:, 3] >= 0) &
+                  (extents[:, 0] <= self.width) & (extents[:, 1] <= self.height))
+        extents = extents[inside].astype(np.int64)
+        np.clip(extents, 0, [self.width, self.height, self.width, self.height], out=extents)
+        self.extents = np.concatenate([self.extents, extents])
+        if self._occupancy is not None:
+            self._stamp(extents)
+
+    def _stamp(self, extents):
+        for x0, y0, x1, y1 in extents.tolist():
+            self._occupancy[y0:y1 + 1, x0:x1 + 1] = True
+
+    def free_positions(self, ins_img_size):
+        """
+        :param ins_img_size: instance的(width, height)
+        :return: 布尔数组，形状为(height - h + 1, width - w + 1)，[y, x]为True表示左上角放在(x, y)时不与已有bbox重叠；
+                 instance比背景大时返回None
+        """
+        w, h = ins_img_size
+        if w > self.width or h > self.height:
+            return None
+        if self._occupancy is None:
+            self._occupancy = np.zeros((self.height + 1, self.width + 1), dtype=np.bool_)
+            self._stamp(self.extents)
+        # 左上角(x, y)的instance覆盖像素点x~x+w、y~y+h，该区域内有任一占用点即被禁止
+        return ~_dilate(_dilate(self._occupancy, w + 1, axis=1), h + 1, axis=0)
+
+    def sample(self, ins_img_size):
+        """
+        从所有合法左上角坐标中均匀抽取一个
+        :param ins_img_size: instance的(width, height)
+        :return: (x, y)；没有合法位置时返回(None, None)
+        """
+        w, h = ins_img_size
+        if w > self.width or h > self.height:
+            return None, None
+        # 随机尝试与栅格使用同样取整后的外接框，接受的坐标同样在合法坐标集合上均匀分布
+        x, y = find_non_overlapping_position(ins_img_size, (self.width, self.height), self.extents,
+                                             self.REJECTION_ATTEMPTS, rng=self.rng)
+        if x is not None:
+            return x, y
+
+        free = self.free_positions(ins_img_size)
+        row_counts = np.count_nonzero(free, axis=1).cumsum()
+        if not row_counts[-1]:
+            return None, None
+        # 先按每行合法位置数选行，再在该行内选列，避免展开全部合法坐标
+        k = self.rng.randrange(int(row_counts[-1]))
+        y = int(np.searchsorted(row_counts, k, side='right'))
+        k -= int(row_counts[y - 1]) if y > 0 else 0
+        x = int(np.flatnonzero(free[y])[k])
+        return x, y
+
+
+class RejectionSampler:
+    """
+    随机尝试坐标直到不重叠的粘贴位置采样器（拒绝采样），接口与FreeSpaceSampler一致。
+    已有bbox的外接框每张合成图只计算一次，每批尝试的坐标一次性与全部外接框比较；可通过tolerance允许一定程度的重叠
+    """
+
+    def __init__(self, bg_img_size, existing_bounding_boxes=None, max_attempts=None, tolerance=None, metric='ioa',
+                 rng=random):
+        """
+        :param bg_img_size: 背景图(width, height)
+        :param existing_bounding_boxes: dict，category -> bbox列表或(N, 8)数组
+        :param max_attempts: 每个instance最大尝试次数
+        :param tolerance: 允许的重叠程度，见image_tools.is_overlap_batch
+        :param metric: 重叠程度的计算方式，见image_tools.is_overlap_batch
+        :param rng: 随机数生成器（random.Random），默认使用random模块的全局状态
+        """
+        self.bg_img_size = bg_img_size
+        self.rng = rng
+        self.max_attempts = max_attempts
+        self.tolerance = tolerance
+        self.metric = metric
+        self.extents = get_box_extents(existing_bounding_boxes or {})
+
+    def occupy(self, boxes):
+        self.extents = np.concatenate([self.extents, get_box_extents(boxes)])
+
+    def sample(self, ins_img_size):
+        return find_non_overlapping_position(ins_img_size, self.bg_img_size, self.extents, self.max_attempts,
+                                             self.tolerance, self.metric, self.rng)